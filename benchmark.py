@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Compare the language models of the exercises on the same data split: the n-gram model of ex7 and the
+char RNN and fixed-context models of ex9 (trained by their scripts, evaluated with the NumPy engine of
+ex9/quantized.py). Every model is trained and served in processes of their own, so the peak memory of
+training and serving is measured separately. The training time and memory are saved next to the trained model,
+so runs that reuse it report them as well."""
+
+import argparse
+import json
+import os
+import pickle
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, 'ex7'))
+sys.path.append(os.path.join(ROOT, 'ex9'))
+
+from readers import LineReader
+
+# neural models: training script of ex9, its checkpoint and the file of its int8 export
+SCRIPTS = {
+    'charnn': ('charnnlm.py', 'charnnlm.npz', 'charnnlm.int8.npz'),
+    'fixedcontext': ('fixedcontextnn.py', 'fixedcontextnn.npz', 'fixedcontextnn.int8.npz'),
+}
+MODELS = ['ngram'] + list(SCRIPTS)
+NGRAM_FILE = 'ngram.pkl'  # the n-gram model for serving
+SPLIT_FILE = 'split.json'  # the parameters of the split in the working directory
+
+
+def split_data(data, workdir, test_fraction, seed):
+    """Write a random train/test split of the lines of data to workdir (train.txt and, for the ex9 scripts,
+    input.txt); test lines with chars that don't occur in the training lines are left out. The split is
+    only rewritten if it was made from other data or parameters; return whether it was."""
+
+    split = {'data': os.path.abspath(data), 'data_mtime': os.path.getmtime(data), 'test_fraction': test_fraction,
+             'seed': seed}
+    split_file = os.path.join(workdir, SPLIT_FILE)
+    if os.path.exists(split_file):
+        with open(split_file, 'r') as f:
+            if json.load(f) == split:
+                return False
+
+    lines = list(LineReader(data))
+    random.Random(seed).shuffle(lines)
+    test_size = int(len(lines) * test_fraction)
+    train, test = lines[test_size:], lines[:test_size]
+    chars = set().union(*train)
+    test = [line for line in test if set(line) <= chars]
+
+    os.makedirs(workdir, exist_ok=True)
+    for name, part in ('train.txt', train), ('input.txt', train), ('test.txt', test):
+        with open(os.path.join(workdir, name), 'w', encoding='utf-8') as f:
+            f.writelines(line + '\n' for line in part)
+    with open(split_file, 'w') as f:
+        json.dump(split, f)
+    return True
+
+
+def model_file(name, workdir):
+    """The file of a trained model, its training info is saved in the same file with .train.json appended"""
+
+    return os.path.join(workdir, NGRAM_FILE if name == 'ngram' else SCRIPTS[name][2])
+
+
+def training_parameters(name, args):
+    """The arguments a trained model depends on (besides the split)"""
+
+    return {'N': args.N, 'smoothing': args.smoothing} if name == 'ngram' else {}
+
+
+def remove_model(name, workdir):
+    """Delete a trained model and its training info (and the checkpoint of a neural model), so it is
+    trained from scratch"""
+
+    filenames = [model_file(name, workdir)]
+    if name in SCRIPTS:
+        filenames.append(os.path.join(workdir, SCRIPTS[name][1]))
+    for path in filenames + [filenames[0] + '.train.json']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_training_info(name, workdir):
+    """Return the training info of a model, None if it was not trained (completely)"""
+
+    info_file = model_file(name, workdir) + '.train.json'
+    if not os.path.exists(info_file) or not os.path.exists(model_file(name, workdir)):
+        return None
+    with open(info_file, 'r') as f:
+        return json.load(f)
+
+
+def peak_memory(who=resource.RUSAGE_SELF):
+    """Peak resident memory of this process (or its finished children) in MB"""
+
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def measure(score, generate, test, samples):
+    """Return the perplexity per token and the scoring and generation throughput of a model, score(line)
+    returns the log2 probability and number of tokens of a line, generate() the number of generated tokens"""
+
+    start = time.perf_counter()
+    log_prob = 0
+    tokens = 0
+    for line in test:
+        line_log_prob, line_tokens = score(line)
+        log_prob += line_log_prob
+        tokens += line_tokens
+    score_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generated = sum(generate() for _ in range(samples))
+    generate_time = time.perf_counter() - start
+
+    return {
+        'perplexity': 2 ** (-log_prob / tokens),
+        'score_tokens_per_sec': tokens / score_time,
+        'generate_tokens_per_sec': generated / generate_time,
+    }
+
+
+def train_ngram(args):
+    import line_by_line_ngrams as ngrams
+    from tokenization import TOKENIZERS
+
+    train = os.path.join(args.workdir, 'train.txt')
+    tokenizer = TOKENIZERS['char']()
+    with open(train, 'r', encoding='utf-8') as f:
+        tokenizer.fit(f)
+    model, alphabet_base = ngrams.build_model(train, args.N, tokenizer)
+    smoothed = ngrams.smooth_model(model, alphabet_base, args.N, args.smoothing)
+    compiled = ngrams.compile_model(ngrams.to_backoff_model(smoothed))
+    # generation from the smoothed model needs neither the counts nor the alphabet base
+    with open(model_file('ngram', args.workdir), 'wb') as f:
+        pickle.dump((tokenizer, smoothed, compiled), f)
+
+
+def train_neural(name, args):
+    # the script trains on input.txt of the working directory and exports the model when done; it would
+    # resume from its checkpoint, which was deleted before, so the training time is that of a full training
+    subprocess.run([sys.executable, os.path.join(ROOT, 'ex9', SCRIPTS[name][0])], cwd=args.workdir, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def train(name, args):
+    """Train one model (in this process or, for the neural models, its children) from scratch and save its
+    training time and peak memory next to it"""
+
+    remove_model(name, args.workdir)
+    start = time.perf_counter()
+    if name == 'ngram':
+        train_ngram(args)
+        train_memory = peak_memory()
+    else:
+        train_neural(name, args)
+        train_memory = peak_memory(resource.RUSAGE_CHILDREN)
+    info = {'train_time': time.perf_counter() - start, 'train_memory_mb': train_memory,
+            'parameters': training_parameters(name, args)}
+    with open(model_file(name, args.workdir) + '.train.json', 'w') as f:
+        json.dump(info, f)
+
+
+def serve_ngram(args):
+    import line_by_line_ngrams as ngrams
+
+    with open(model_file('ngram', args.workdir), 'rb') as f:
+        tokenizer, smoothed, compiled = pickle.load(f)
+
+    def score(line):
+        log_probs = ngrams.score_ids(compiled, tokenizer.encode(line))
+        return sum(log_probs), len(log_probs)
+
+    def generate():
+        # the end symbol counts as generated token
+        return len(list(ngrams.generate_text(None, None, args.N, '', tokenizer, smoothed, args.max_length))) + 1
+
+    return score, generate
+
+
+def serve_neural(name, args):
+    import numpy as np
+    from quantized import load_quantized
+
+    model = load_quantized(model_file(name, args.workdir))
+    np.random.seed(args.random_seed)
+
+    def score(line):
+        _, bits, tokens = model.assess(line)
+        return -bits, tokens
+
+    def generate():
+        return len(model.generate(max_length=args.max_length)) + 1
+
+    return score, generate
+
+
+def run(name, args):
+    """Benchmark one trained model (served in this process) and return its results"""
+
+    random.seed(args.random_seed)
+    test = list(LineReader(os.path.join(args.workdir, 'test.txt')))
+    if name == 'ngram':
+        score, generate = serve_ngram(args)
+    else:
+        score, generate = serve_neural(name, args)
+    results = measure(score, generate, test, args.samples)
+    # only loading and running the model counts, training happened in other processes
+    results['serve_memory_mb'] = peak_memory()
+
+    info = load_training_info(name, args.workdir)
+    results.update(train_time=info['train_time'], train_memory_mb=info['train_memory_mb'])
+    return results
+
+
+def format_table(results):
+    columns = ['model', 'train_time', 'train_memory_mb', 'serve_memory_mb', 'perplexity', 'score_tokens_per_sec',
+               'generate_tokens_per_sec']
+    rows = [columns]
+    for name, result in results.items():
+        rows.append([name] + ['-' if result.get(column) is None else f'{result[column]:.2f}'
+                              for column in columns[1:]])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def main(args):
+    if args.train:
+        train(args.train, args)
+        return
+    if args.run:
+        print(json.dumps(run(args.run, args)))
+        return
+
+    if split_data(args.data, args.workdir, args.test_fraction, args.random_seed):
+        # models trained on another split would be tested on their training lines
+        for name in MODELS:
+            remove_model(name, args.workdir)
+
+    # every model is trained (if needed) and served in new processes with the same arguments
+    results = {}
+    for name in args.models:
+        info = load_training_info(name, args.workdir)
+        if args.retrain or info is None or info['parameters'] != training_parameters(name, args):
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--train', name] + sys.argv[1:], check=True)
+        command = [sys.executable, os.path.abspath(__file__), '--run', name] + sys.argv[1:]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[name] = json.loads(output.strip().splitlines()[-1])
+
+    print(format_table(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the language models of ex7 and ex9 on the same data')
+    parser.add_argument('--data', type=str, default=os.path.join(ROOT, 'ex9', 'input.txt'),
+                        help='Text file with one sentence per line, split into training and test lines')
+    parser.add_argument('--test-fraction', type=float, default=0.1, help='Fraction of the lines used for testing')
+    parser.add_argument('--workdir', type=str, default='benchmark', help='Directory for the split and the models')
+    parser.add_argument('--models', type=str, nargs='+', default=MODELS, choices=MODELS, help='Models to compare')
+    parser.add_argument('--retrain', action='store_true', help='Train the models even if they were trained before')
+    parser.add_argument('-N', type=int, default=5, help='Order of the n-gram model')
+    parser.add_argument('--smoothing', type=str, default='kneser-ney', choices=['kneser-ney', 'witten-bell'],
+                        help='Smoothing of the n-gram model')
+    parser.add_argument('--samples', type=int, default=20, help='Number of generated sentences per model')
+    parser.add_argument('--max-length', type=int, default=200, help='Maximum length of a generated sentence')
+    parser.add_argument('--json', type=str, required=False, help='File to write the results to as JSON')
+    parser.add_argument('--random-seed', type=int, default=0, help='Seed of the split and the generation')
+    parser.add_argument('--train', type=str, choices=MODELS, help=argparse.SUPPRESS)
+    parser.add_argument('--run', type=str, choices=MODELS, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    # start program
+    main(args)
@@ -0,0 +1,88 @@
+import numpy as np
+
+CHUNK_SIZE = 4096 # pairs whose edit distances are computed together
+
+
+# Return the sequences (lists of symbols) as padded int array, the lengths and the ids of the symbols
+def to_ids(sequences, symbol2id, pad=-1):
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    ids = np.full((len(sequences), max(lengths.max(initial=0), 1)), pad, dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+        ids[row, :len(sequence)] = [symbol2id.setdefault(symbol, len(symbol2id)) for symbol in sequence]
+    return ids, lengths
+
+
+# Return the Levenshtein distances of the pairs of padded id arrays (with their lengths): the DP runs
+# over the reference positions for all pairs and hypothesis positions at once, the insertions within a
+# row are resolved with a cumulative minimum (D[i][j] = min over k <= j of T[k] + j - k)
+def batch_distances(references, reference_lengths, hypotheses, hypothesis_lengths):
+    pairs, max_hypothesis = hypotheses.shape
+    columns = np.arange(max_hypothesis + 1)
+    row = np.tile(columns, (pairs, 1)) # D[0][j] = j insertions
+    distances = np.where(reference_lengths == 0, hypothesis_lengths, 0)
+    for i in range(1, references.shape[1] + 1):
+        substitution = row[:, :-1] + (hypotheses != references[:, i - 1:i])
+        deletion = row + 1
+        t = np.empty_like(row)
+        t[:, 0] = deletion[:, 0]
+        t[:, 1:] = np.minimum(deletion[:, 1:], substitution)
+        row = np.minimum.accumulate(t - columns, axis=1) + columns
+        done = reference_lengths == i
+        distances[done] = row[done, hypothesis_lengths[done]]
+    return distances
+
+
+# Return the edit distances of all pairs of reference and hypothesis sequences (lists of symbols)
+def edit_distances(references, hypotheses):
+    symbol2id = {}
+    distances = np.zeros(len(references), dtype=np.int64)
+    # similar lengths in one chunk, so there is little padding
+    order = sorted(range(len(references)), key=lambda j: (len(references[j]), len(hypotheses[j])))
+    for start in range(0, len(order), CHUNK_SIZE):
+        chunk = order[start:start + CHUNK_SIZE]
+        references_ids, reference_lengths = to_ids([references[j] for j in chunk], symbol2id, pad=-1)
+        hypotheses_ids, hypothesis_lengths = to_ids([hypotheses[j] for j in chunk], symbol2id, pad=-2)
+        distances[chunk] = batch_distances(references_ids, reference_lengths, hypotheses_ids, hypothesis_lengths)
+    return distances
+
+
+# Return the phoneme error rate: edit distance of all pairs / number of reference phonemes
+def phoneme_error_rate(references, hypotheses):
+    return edit_distances(references, hypotheses).sum() / sum(len(reference) for reference in references)
+
+
+# Return the word error rate: fraction of the words whose hypothesis is not exactly the reference
+def word_error_rate(references, hypotheses):
+    return sum(list(reference) != list(hypothesis) for reference, hypothesis in zip(references, hypotheses)) / len(references)
+
+
+# Return the edit distance and an alignment (list of (reference symbol, hypothesis symbol) pairs,
+# None for insertions and deletions) of one pair of sequences
+def align(reference, hypothesis):
+    D = np.zeros((len(reference) + 1, len(hypothesis) + 1), dtype=np.int64)
+    D[:, 0] = np.arange(len(reference) + 1)
+    D[0, :] = np.arange(len(hypothesis) + 1)
+    for i in range(1, len(reference) + 1):
+        for j in range(1, len(hypothesis) + 1):
+            D[i, j] = min(D[i - 1, j] + 1, D[i, j - 1] + 1, D[i - 1, j - 1] + (reference[i - 1] != hypothesis[j - 1]))
+
+    alignment = []
+    i, j = len(reference), len(hypothesis)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and D[i, j] == D[i - 1, j - 1] + (reference[i - 1] != hypothesis[j - 1]):
+            alignment.append((reference[i - 1], hypothesis[j - 1]))
+            i, j = i - 1, j - 1
+        elif i > 0 and D[i, j] == D[i - 1, j] + 1:
+            alignment.append((reference[i - 1], None))
+            i -= 1
+        else:
+            alignment.append((None, hypothesis[j - 1]))
+            j -= 1
+    return int(D[-1, -1]), alignment[::-1]
+
+
+if __name__ == "__main__":
+    reference = "r e: g e n s b U r k".split()
+    hypothesis = "r e: g N s b U 6 k".split()
+    print(phoneme_error_rate([reference], [hypothesis]), word_error_rate([reference], [hypothesis]))
+    print(align(reference, hypothesis))
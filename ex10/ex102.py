@@ -1,10 +1,20 @@
 import dynet as dy
+import os
 import random
+import sys
+import numpy as np
+
+from error_rate import phoneme_error_rate, word_error_rate
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vocabulary import Vocabulary
+from readers import IndexedLineReader
 
 START_SYMBOL = "<s>"
 END_SYMBOL = "</s>"
 
-lines = open('data/Cocolab_DE.lex', 'r').read().splitlines()
+# the lines are read from disk when they are needed
+lines = IndexedLineReader('data/Cocolab_DE.lex')
 
 # Preprocessing: Create vocabulary and convert graphemes and phonemes to indices
 grapheme_vocab = set()
@@ -17,30 +27,45 @@ for line in lines:
 
 grapheme_vocab.add(START_SYMBOL)
 grapheme_vocab.add(END_SYMBOL)
+# the decoder starts with <s> and predicts </s> at the end
+phoneme_vocab.add(START_SYMBOL)
+phoneme_vocab.add(END_SYMBOL)
 
-grapheme2int = {c: i for i, c in enumerate(grapheme_vocab)}
-int2grapheme = list(grapheme_vocab)
-phoneme2int = {c: i for i, c in enumerate(phoneme_vocab)}
-int2phoneme = list(phoneme_vocab)
+# sorted, so the ids don't depend on the set iteration order
+grapheme_vocabulary = Vocabulary(sorted(grapheme_vocab))
+phoneme_vocabulary = Vocabulary(sorted(phoneme_vocab))
+int2grapheme = grapheme_vocabulary.symbols
+grapheme2int = grapheme_vocabulary.ids
+int2phoneme = phoneme_vocabulary.symbols
+phoneme2int = phoneme_vocabulary.ids
 
 VOCAB_SIZE = len(grapheme_vocab)
 PHONEME_SIZE = len(phoneme_vocab)
 
 MAX_EPOCHS = 50
 STOP_EARLY = True  # stop early if there's no change for a while
+PATIENCE = 3 # epochs without improvement of the dev loss until training stops
+BATCH_SIZE = 32
+DEV_SIZE = 500 # held-out words
+MODEL_FILE = "g2p.model" # the parameters of the best epoch
 
 INPUT_DIM = 64
 HIDDEN_DIM = 32
 LAYERS = 1
 
-random.shuffle(lines)
+BEAM_WIDTH = 5
+LENGTH_NORMALIZATION = 1.0 # the score of a hypothesis is log probability / length ** LENGTH_NORMALIZATION
+MAX_LENGTH = 2 # at most MAX_LENGTH phonemes per grapheme (+ 1) are decoded
+
 training_data = []
 
-for line in lines:
+# a fixed random order, so the dev split is the same for every run
+for line in lines.shuffled(seed=0):
     grapheme, phoneme = line.split("\t")
     grapheme_indices = [grapheme2int[c] for c in grapheme]
     phoneme_indices = [phoneme2int[p] for p in phoneme.split()]
     training_data.append((grapheme_indices, phoneme_indices))
+training_data, dev_data = training_data[DEV_SIZE:], training_data[:DEV_SIZE]
 
 pc = dy.ParameterCollection()
 encoder_rnn = dy.LSTMBuilder(LAYERS, INPUT_DIM, HIDDEN_DIM, pc)
@@ -49,44 +74,281 @@ decoder_rnn = dy.LSTMBuilder(LAYERS, INPUT_DIM + HIDDEN_DIM, HIDDEN_DIM, pc)
 params = {}
 params["encoder_lookup"] = pc.add_lookup_parameters((VOCAB_SIZE, INPUT_DIM))
 params["decoder_lookup"] = pc.add_lookup_parameters((PHONEME_SIZE, INPUT_DIM))
+params["attention"] = pc.add_parameters((HIDDEN_DIM, HIDDEN_DIM))
 params["W"] = pc.add_parameters((PHONEME_SIZE, HIDDEN_DIM))
 params["bias"] = pc.add_parameters((PHONEME_SIZE,))
 
 
-# Return the encoding of a grapheme sequence
-def encode_sequence(graphemes):
-    dy.renew_cg()
+# Return the batched encoding of grapheme sequences of the same length (in the current graph): the encoder
+# states as columns of a matrix and its transpose, computed once and reused by all decoder steps and hypotheses
+def encode_batch(sequences):
     encoder_lookup = params["encoder_lookup"]
     s = encoder_rnn.initial_state()
-    rnn_output = s.transduce([encoder_lookup[grapheme] for grapheme in graphemes])[-1]
-    return rnn_output
+    columns = [dy.lookup_batch(encoder_lookup, list(graphemes)) for graphemes in zip(*sequences)]
+    states = dy.concatenate_cols(s.transduce(columns))
+    return states, dy.transpose(states)
 
 
-# Return the decoded phoneme sequence given the encoding
-def decode_sequence(encoding, target_sequence):
-    dy.renew_cg()
+# Return the encoding of a grapheme sequence (in the current graph)
+def encode_sequence(graphemes):
+    return encode_batch([graphemes])
+
+
+# Return the attention context for the decoder state s: the encoder states weighted by
+# softmax(states^T * A * output of s) (before the first phoneme all states are weighted equally)
+def attend(s, encoding):
+    states, states_t = encoding
+    if s.output() is None:
+        query = dy.zeros(HIDDEN_DIM)
+    else:
+        query = params["attention"] * s.output()
+    return states * dy.softmax(states_t * query)
+
+
+# Return the decoder state after reading the phonemes (list with one id per batch element),
+# the attention context over the encoding is part of every input
+def decoder_step(s, phonemes, encoding):
     decoder_lookup = params["decoder_lookup"]
+    return s.add_input(dy.concatenate([dy.lookup_batch(decoder_lookup, phonemes), attend(s, encoding)]))
+
+
+# Return the phonemes predicted greedily for every position of the target sequence given the
+# encoding, reading the target phonemes instead of the predictions (teacher forcing)
+def decode_sequence(encoding, target_sequence):
     W = params["W"]
     bias = params["bias"]
-    s = decoder_rnn.initial_state(dy.concatenate([encoding, dy.inputTensor([0] * INPUT_DIM)]))
+    s = decoder_rnn.initial_state()
     decoded_phonemes = []
-    for target in target_sequence:
-        s = s.add_input(decoder_lookup[target])
-        rnn_output = s.output()
-        probs = dy.softmax(W * rnn_output + bias)
-        prediction = dy.argmax(probs)
-        decoded_phonemes.append(int(prediction.value()))
-    return decoded_phonemes
-
-
-# Example usage
-graphemes = [START_SYMBOL] + list("erfüllt") + [END_SYMBOL]
-encoding = encode_sequence([grapheme2int[grapheme] for grapheme in graphemes]).npvalue()
-
-target_phonemes = [phoneme2int[p] for p in "E 6 f Y l t".split()]
-decoded_phonemes = decode_sequence(encoding, target_phonemes)
-decoded_phonemes = [int2phoneme[phoneme] for phoneme in decoded_phonemes]
-
-print("Graphemes:", graphemes)
-print("Target Phonemes:", "E 6 f Y l t".split())
-print("Decoded Phonemes:", decoded_phonemes)
\ No newline at end of file
+    for previous in [phoneme2int[START_SYMBOL]] + target_sequence[:-1]:
+        s = decoder_step(s, [previous], encoding)
+        decoded_phonemes.append(W * s.output() + bias)
+    return [int(i) for i in dy.concatenate_cols(decoded_phonemes).npvalue().reshape(PHONEME_SIZE, -1).argmax(axis=0)]
+
+
+# Return the grapheme ids of a word (string) with <s> and </s>, graphemes that don't occur in the lexicon are skipped
+def grapheme_ids(word):
+    return [grapheme2int[c] for c in [START_SYMBOL] + [c for c in word if c in grapheme2int] + [END_SYMBOL]]
+
+
+# Return the most probable phoneme sequence (ids without <s> and </s>) for a word (string) found by beam search,
+# the encoding and all hypotheses are computed in one graph
+def beam_search(word, beam_width=BEAM_WIDTH, length_normalization=LENGTH_NORMALIZATION, max_length=None):
+    dy.renew_cg()
+    W = params["W"]
+    bias = params["bias"]
+    max_length = max_length or MAX_LENGTH * len(word) + 1
+    end = phoneme2int[END_SYMBOL]
+
+    encoding = encode_sequence(grapheme_ids(word))
+
+    # hypotheses are (log probability, phonemes, decoder state after reading the last phoneme)
+    beam = [(0.0, [], decoder_step(decoder_rnn.initial_state(), [phoneme2int[START_SYMBOL]], encoding))]
+    finished = []
+    for length in range(1, max_length + 1):
+        # the log probabilities of all hypotheses in one forward pass
+        log_probs = dy.concatenate_cols([dy.log_softmax(W * s.output() + bias) for _, _, s in beam])
+        log_probs = log_probs.npvalue().reshape(PHONEME_SIZE, len(beam))
+        # <s> is in the output vocabulary but is never a valid output
+        log_probs[phoneme2int[START_SYMBOL]] = -np.inf
+
+        # the best beam_width continuations of every hypothesis are enough candidates
+        candidates = []
+        for j, (log_prob, phonemes, s) in enumerate(beam):
+            for i in np.argsort(-log_probs[:, j])[:beam_width]:
+                if log_probs[i, j] == -np.inf:
+                    break
+                candidates.append((log_prob + log_probs[i, j], phonemes, s, int(i)))
+        candidates.sort(key=lambda candidate: -candidate[0])
+
+        beam = []
+        for log_prob, phonemes, s, i in candidates[:beam_width]:
+            if i == end:
+                finished.append((log_prob / length ** length_normalization, phonemes))
+            else:
+                beam.append((log_prob, phonemes + [i], s))
+        # stop when no hypothesis can be extended any more
+        if not beam or len(finished) >= beam_width:
+            break
+        beam = [(log_prob, phonemes, decoder_step(s, [phonemes[-1]], encoding)) for log_prob, phonemes, s in beam]
+
+    if not finished:
+        # no hypothesis ended within max_length, take the best unfinished one
+        finished = [(log_prob / max_length ** length_normalization, phonemes) for log_prob, phonemes, _ in beam]
+    return max(finished, key=lambda hypothesis: hypothesis[0])[1]
+
+
+# Return the phoneme sequences (ids without <s> and </s>) of words with the same number of known graphemes,
+# decoded greedily as one batch
+def greedy_decode_batch(words, max_length=None):
+    dy.renew_cg()
+    W = params["W"]
+    bias = params["bias"]
+    max_length = max_length or MAX_LENGTH * max(len(word) for word in words) + 1
+    end = phoneme2int[END_SYMBOL]
+
+    encoding = encode_batch([grapheme_ids(word) for word in words])
+    s = decoder_step(decoder_rnn.initial_state(), [phoneme2int[START_SYMBOL]] * len(words), encoding)
+    decoded = [[] for _ in words]
+    finished = [False] * len(words)
+    for _ in range(max_length):
+        scores = (W * s.output() + bias).npvalue().reshape(PHONEME_SIZE, len(words))
+        # <s> is in the output vocabulary but is never a valid output
+        scores[phoneme2int[START_SYMBOL]] = -np.inf
+        predictions = scores.argmax(axis=0)
+        for j, prediction in enumerate(predictions):
+            if prediction == end:
+                finished[j] = True
+            elif not finished[j]:
+                decoded[j].append(int(prediction))
+        if all(finished):
+            break
+        # finished words keep reading </s>, their predictions are ignored
+        s = decoder_step(s, [int(i) for i in predictions], encoding)
+    return decoded
+
+
+# Return the phonemes (strings) of a word
+def transcribe(word, beam_width=BEAM_WIDTH):
+    return [int2phoneme[phoneme] for phoneme in beam_search(word, beam_width)]
+
+
+# Return the phonemes (strings) of several words; with beam width 1 words with the same number of
+# known graphemes are decoded greedily in batches of BATCH_SIZE, otherwise every word gets a beam search
+def transcribe_batch(words, beam_width=BEAM_WIDTH):
+    if beam_width > 1:
+        return [transcribe(word, beam_width) for word in words]
+
+    buckets = {}
+    for j, word in enumerate(words):
+        buckets.setdefault(len(grapheme_ids(word)), []).append(j)
+    transcriptions = [None] * len(words)
+    for bucket in buckets.values():
+        for i in range(0, len(bucket), BATCH_SIZE):
+            batch = bucket[i:i + BATCH_SIZE]
+            for j, phonemes in zip(batch, greedy_decode_batch([words[j] for j in batch])):
+                transcriptions[j] = [int2phoneme[phoneme] for phoneme in phonemes]
+    return transcriptions
+
+
+# Return the summed loss of a batch of (graphemes, phonemes) pairs whose graphemes have the same length
+# and the number of predicted phonemes; the decoder reads the correct previous phonemes (teacher forcing)
+def do_one_batch(batch):
+    dy.renew_cg()
+    W = params["W"]
+    bias = params["bias"]
+    start, end = phoneme2int[START_SYMBOL], phoneme2int[END_SYMBOL]
+
+    encoding = encode_batch([[grapheme2int[START_SYMBOL]] + graphemes + [grapheme2int[END_SYMBOL]]
+                             for graphemes, _ in batch])
+
+    # the phoneme sequences are padded with </s>, the padded positions are masked
+    targets = [phonemes + [end] for _, phonemes in batch]
+    max_len = max(len(target) for target in targets)
+    s = decoder_rnn.initial_state()
+    loss = []
+    symbols = 0
+    for i in range(max_len):
+        previous = [start if i == 0 else target[i - 1] if i - 1 < len(target) else end for target in targets]
+        next_phonemes = [target[i] if i < len(target) else end for target in targets]
+        mask = [1 if i < len(target) else 0 for target in targets]
+        symbols += sum(mask)
+
+        s = decoder_step(s, previous, encoding)
+        phoneme_loss = dy.pickneglogsoftmax_batch(W * s.output() + bias, next_phonemes)
+        if 0 in mask:
+            phoneme_loss = phoneme_loss * dy.reshape(dy.inputVector(mask), (1,), len(mask))
+        loss.append(phoneme_loss)
+    return dy.sum_batches(dy.esum(loss)), symbols
+
+
+# Split the data into batches of words with the same number of graphemes (so the encoder needs no padding),
+# in random order
+def make_batches(data, batch_size, rng=random):
+    buckets = {}
+    for graphemes, phonemes in data:
+        buckets.setdefault(len(graphemes), []).append((graphemes, phonemes))
+    batches = []
+    for bucket in buckets.values():
+        batches += [bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size)]
+    rng.shuffle(batches)
+    return batches
+
+
+# Return the loss per phoneme of the data (without updates)
+def evaluate(data):
+    loss = 0
+    symbols = 0
+    for batch in make_batches(data, BATCH_SIZE):
+        batch_loss, batch_symbols = do_one_batch(batch)
+        loss += batch_loss.value()
+        symbols += batch_symbols
+    return loss / symbols
+
+
+# Train on the training data and keep the parameters of the epoch with the lowest dev loss in MODEL_FILE
+def train(trainer):
+    best_loss = float("inf")
+    bad_epochs = 0
+    for epoch in range(MAX_EPOCHS):
+        train_loss = 0
+        train_symbols = 0
+        for batch in make_batches(training_data, BATCH_SIZE):
+            loss, symbols = do_one_batch(batch)
+            train_loss += loss.value()
+            train_symbols += symbols
+            loss.backward()
+            trainer.update()
+
+        dev_loss = evaluate(dev_data)
+        # error rates of the greedily decoded dev words
+        words = ["".join(int2grapheme[grapheme] for grapheme in graphemes) for graphemes, _ in dev_data]
+        references = [[int2phoneme[phoneme] for phoneme in phonemes] for _, phonemes in dev_data]
+        hypotheses = transcribe_batch(words, beam_width=1)
+        print(epoch, train_loss / train_symbols, dev_loss, phoneme_error_rate(references, hypotheses),
+              word_error_rate(references, hypotheses), " ".join(transcribe("erfüllt")))
+        if dev_loss < best_loss:
+            best_loss = dev_loss
+            bad_epochs = 0
+            save_model()
+        else:
+            bad_epochs += 1
+            if STOP_EARLY and bad_epochs >= PATIENCE:
+                break
+    pc.populate(MODEL_FILE)
+
+
+# Save the parameters and the vocabularies (their ids must be the same when the model is loaded)
+def save_model(filename=MODEL_FILE):
+    pc.save(filename)
+    grapheme_vocabulary.save(filename + ".graphemes.json")
+    phoneme_vocabulary.save(filename + ".phonemes.json")
+
+
+# Load the parameters of a trained model
+def load_model(filename=MODEL_FILE):
+    if os.path.exists(filename + ".graphemes.json"):
+        for name, vocabulary in ("graphemes", grapheme_vocabulary), ("phonemes", phoneme_vocabulary):
+            if Vocabulary.load(filename + "." + name + ".json").symbols != vocabulary.symbols:
+                raise ValueError("the %s of %s differ from the ones of the lexicon" % (name, filename))
+    pc.populate(filename)
+
+
+if __name__ == "__main__":
+    if os.path.exists(MODEL_FILE):
+        load_model()
+    else:
+        train(dy.AdamTrainer(pc))
+
+    # Example usage
+    dy.renew_cg()
+    graphemes = [START_SYMBOL] + list("erfüllt") + [END_SYMBOL]
+    encoding = encode_sequence([grapheme2int[grapheme] for grapheme in graphemes])
+
+    target_phonemes = [phoneme2int[p] for p in "E 6 f Y l t".split()] + [phoneme2int[END_SYMBOL]]
+    decoded_phonemes = decode_sequence(encoding, target_phonemes)
+    decoded_phonemes = [int2phoneme[phoneme] for phoneme in decoded_phonemes]
+
+    print("Graphemes:", graphemes)
+    print("Target Phonemes:", "E 6 f Y l t".split())
+    print("Decoded Phonemes (teacher forcing):", decoded_phonemes)
+    print("Decoded Phonemes (beam search):", transcribe("erfüllt"))
\ No newline at end of file
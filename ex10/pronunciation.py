@@ -0,0 +1,130 @@
+import sys
+from collections import OrderedDict
+
+LEXICON_FILE = "data/Cocolab_DE.lex"
+MIN_PART = 3 # minimal length of a compound part
+CACHE_SIZE = 10000 # model outputs kept for recently seen words
+
+
+# the pronunciations of a lexicon, as dict for whole words and as trie (nested dicts, the
+# pronunciation is stored under the key None) of the lowercased words for decompounding
+class Lexicon:
+
+    def __init__(self, entries=()):
+        self.words = {}
+        self.trie = {}
+        for word, phonemes in entries:
+            self.add(word, phonemes)
+
+    # read a lexicon file with one word, tab and space separated phonemes per line
+    @classmethod
+    def load(cls, filename=LEXICON_FILE):
+        with open(filename, 'r') as f:
+            return cls((word, phonemes.split()) for word, phonemes in (line.rstrip("\n").split("\t") for line in f))
+
+    def add(self, word, phonemes):
+        self.words.setdefault(word, phonemes)
+        node = self.trie
+        for c in word.lower():
+            node = node.setdefault(c, {})
+        node.setdefault(None, phonemes)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def __len__(self):
+        return len(self.words)
+
+    # return the pronunciation of a word (or of its lowercased form), None if it is unknown
+    def lookup(self, word):
+        if word in self.words:
+            return self.words[word]
+        node = self.trie
+        for c in word.lower():
+            node = node.get(c)
+            if node is None:
+                return None
+        return node.get(None)
+
+    # return the pronunciations of all lexicon words that are prefixes of text (lowercase), longest first
+    def prefixes(self, text, min_length=1):
+        found = []
+        node = self.trie
+        for i, c in enumerate(text):
+            node = node.get(c)
+            if node is None:
+                break
+            if i + 1 >= min_length and None in node:
+                found.append((i + 1, node[None]))
+        return found[::-1]
+
+    # return the pronunciation of a compound as concatenation of the pronunciations of its parts (at least
+    # min_part chars each), found by longest prefix matching with backtracking; None if there is no split
+    def decompound(self, word, min_part=MIN_PART):
+        text = word.lower()
+        failed = set() # positions from which the rest can't be split
+
+        def split(start):
+            if start == len(text):
+                return []
+            if start in failed:
+                return None
+            for length, phonemes in self.prefixes(text[start:], min_part):
+                rest = split(start + length)
+                if rest is not None:
+                    return phonemes + rest
+            failed.add(start)
+            return None
+
+        return split(0)
+
+
+# answers known words from the lexicon (or split into known parts), only the rest is transcribed
+# by model (a function from a list of words to a list of phoneme lists) in one batch per call
+class PronunciationService:
+
+    def __init__(self, lexicon, model, decompound=True, cache_size=CACHE_SIZE):
+        self.lexicon = lexicon
+        self.model = model
+        self.decompound = decompound
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # model outputs by word, least recently used first
+
+    # return the pronunciations (lists of phonemes) of the words
+    def pronounce(self, words):
+        pronunciations = [self.lexicon.lookup(word) for word in words]
+        if self.decompound:
+            pronunciations = [phonemes if phonemes is not None else self.lexicon.decompound(word)
+                              for word, phonemes in zip(words, pronunciations)]
+
+        misses = []
+        for j, word in enumerate(words):
+            if pronunciations[j] is not None:
+                continue
+            if word in self.cache:
+                self.cache.move_to_end(word)
+                pronunciations[j] = self.cache[word]
+            else:
+                misses.append(j)
+
+        # every distinct missing word is transcribed once
+        missing = list(dict.fromkeys(words[j] for j in misses))
+        transcribed = dict(zip(missing, self.model(missing))) if missing else {}
+        for word, phonemes in transcribed.items():
+            self.cache[word] = phonemes
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        for j in misses:
+            pronunciations[j] = transcribed[words[j]]
+        return pronunciations
+
+
+if __name__ == "__main__":
+    # pronounce the words given as arguments (or one word per line of stdin)
+    import ex102
+    ex102.load_model()
+    # greedy decoding, so the misses are transcribed in batches
+    service = PronunciationService(Lexicon.load(), lambda words: ex102.transcribe_batch(words, beam_width=1))
+    words = sys.argv[1:] or [line.strip() for line in sys.stdin if line.strip()]
+    for word, phonemes in zip(words, service.pronounce(words)):
+        print(word + "\t" + " ".join(phonemes))
@@ -0,0 +1,85 @@
+import argparse
+import multiprocessing
+import sys
+
+# the model module is imported by the workers only, so the main process doesn't need DyNet
+model = None
+
+
+# load the model once per worker
+def init_worker(model_file):
+    global model
+    import ex102
+    ex102.load_model(model_file)
+    model = ex102
+
+
+def transcribe_words(task):
+    words, beam_width = task
+    return words, model.transcribe_batch(words, beam_width)
+
+
+# return the distinct non-empty words of the lines (one word per line, first occurrence order)
+def read_words(lines):
+    return list(dict.fromkeys(word for word in (line.strip() for line in lines) if word))
+
+
+# yield (word, phonemes) for all words, transcribed in batches of words with similar length
+def transcribe_all(words, model_file, workers=1, batch_size=256, beam_width=1):
+    words = sorted(words, key=len)
+    tasks = [(words[i:i + batch_size], beam_width) for i in range(0, len(words), batch_size)]
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(model_file,)) as pool:
+            for batch, transcriptions in pool.imap(transcribe_words, tasks):
+                yield from zip(batch, transcriptions)
+    else:
+        init_worker(model_file)
+        for task in tasks:
+            batch, transcriptions = transcribe_words(task)
+            yield from zip(batch, transcriptions)
+
+
+def main(args):
+    if args.words == '-':
+        words = read_words(sys.stdin)
+    else:
+        with open(args.words, 'r') as f:
+            words = read_words(f)
+
+    known = {}
+    if args.lexicon:
+        # words of the lexicon are copied instead of transcribed
+        from pronunciation import Lexicon
+        lexicon = Lexicon.load(args.lexicon)
+        known = {word: lexicon.lookup(word) for word in words if lexicon.lookup(word) is not None}
+
+    out = open(args.output, 'w') if args.output != '-' else sys.stdout
+    try:
+        # the same format as Cocolab_DE.lex: word, tab and the phonemes separated by spaces
+        for word, phonemes in known.items():
+            out.write(word + "\t" + " ".join(phonemes) + "\n")
+        missing = [word for word in words if word not in known]
+        for word, phonemes in transcribe_all(missing, args.model, args.workers, args.batch_size, args.beam_width):
+            out.write(word + "\t" + " ".join(phonemes) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Transcribe a word list with the G2P model of ex102.py')
+    parser.add_argument('words', type=str, help='File with one word per line (- for stdin), duplicates are skipped')
+    parser.add_argument('--output', type=str, default='-', help='Lexicon file to write (- for stdout)')
+    parser.add_argument('--model', type=str, default='g2p.model', help='Parameters saved by ex102.py')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of processes, each loads the model once')
+    parser.add_argument('--batch-size', type=int, default=256, help='Number of words per task of a process')
+    parser.add_argument('--beam-width', type=int, default=1,
+                        help='Beam width of the decoding (1 decodes words of the same length as one batch)')
+    parser.add_argument('--lexicon', type=str, required=False,
+                        help='Lexicon (e.g. data/Cocolab_DE.lex) whose words are copied instead of transcribed')
+
+    args = parser.parse_args()
+
+    # start program
+    main(args)
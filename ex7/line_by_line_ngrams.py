@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
+import json
 import random
 import math
+import sys
+from array import array
 
-# define constants
-START_SYMBOL = "<s>"
-END_SYMBOL = "</s>"
+from tokenization import START_ID, END_ID, UNKNOWN_ID, TOKENIZERS
 
 
-def ngrams_from_text(lines, N):
-    """Generate n-grams from text"""
+def ngrams_from_text(lines, N, tokenizer, add=False):
+    """Generate n-grams of token ids from text (unknown symbols are added to
+    the vocabulary of the tokenizer if add is True)"""
 
     for line in lines:
         # prepend start symbol (N - 1) times and append end symbol
-        line = [START_SYMBOL] * (N - 1) + list(line.strip()) + [END_SYMBOL]
+        line = [START_ID] * (N - 1) + tokenizer.encode(line.strip(), add) + [END_ID]
 
         # loop through all n-grams in the line and yield them
         for i in range(len(line) - N + 1):
@@ -26,7 +29,7 @@ def get_base_node(model, prefix):
 
     node = model
 
-    # loop through all chars in prefix
+    # loop through all tokens in prefix
     for c in prefix:
         node = node.get(c)
 
@@ -38,71 +41,633 @@ def get_base_node(model, prefix):
     return node
 
 
-def build_model(source, N):
+def build_model(source, N, tokenizer):
     """Build the n-gram model in form of a nested dict structure
     from the input file"""
 
     model = dict()
-    alphabet_base = dict()  # dict containing all the characters in the alphabet and their base probabilities (1)
+    alphabet_base = dict()  # dict containing all the tokens in the alphabet and their base probabilities (1)
 
-    # open source file and loop through all n-grams
+    # open source file and add all its n-grams
     with open(source, 'r', encoding='utf-8') as f:
-        for ngram in ngrams_from_text(f, N):
-            # get prefix and last character (char to be predicted)
-            prefix, last = ngram[:-1], ngram[-1]
+        update_model(model, alphabet_base, f, N, tokenizer)
 
-            # set root node of model as model itself
-            node = model
+    return model, alphabet_base
 
-            # loop through all characters in prefix and create nodes if they don't exist
-            for c in prefix:
-                node = node.setdefault(c, {})
 
-            # at the end of the nested dict structure
-            # increase the count when found by one
-            # default value is 0 (laplace smoothing)
-            node[last] = node.get(last, 1) + 1
+def update_model(model, alphabet_base, lines, N, tokenizer, smoothed=None):
+    """Add the n-grams of lines (any iterable, i.e. a file or sys.stdin) to an existing model.
+    If the smoothed model is given, its tables are updated in place as well."""
 
-            # add character to alphabet_base if not already in there
-            alphabet_base[last] = 1
+    # (order, history) pairs of the smoothed tables that have to be recomputed
+    changed = set()
+
+    for ngram in ngrams_from_text(lines, N, tokenizer, add=True):
+        # get prefix and last token (token to be predicted)
+        prefix, last = ngram[:-1], ngram[-1]
+
+        # set root node of model as model itself
+        node = model
+
+        # loop through all tokens in prefix and create nodes if they don't exist
+        for c in prefix:
+            node = node.setdefault(c, {})
+
+        # at the end of the nested dict structure
+        # increase the count when found by one
+        # default value is 0 (laplace smoothing)
+        node[last] = node.get(last, 1) + 1
+
+        # add token to alphabet_base if not already in there
+        alphabet_base[last] = 1
+
+        if smoothed is not None:
+            add_ngram_counts(smoothed['counts'], smoothed['continuations'], prefix, last, 1)
+            # only the suffixes of the prefix are affected
+            changed.update((k, prefix[N - 1 - k:]) for k in range(N))
+
+    # recompute the changed tables once per update instead of once per n-gram
+    # (the discounts stay fixed until the model is smoothed again)
+    if smoothed is not None:
+        for k, history in changed:
+            set_table_entry(smoothed, k, history)
+        smoothed['vocabulary'] = list(alphabet_base)
+
+
+def decay_model(model, alphabet_base, N, factor, min_count=None, smoothed=None):
+    """Multiply all counts of the model by factor and remove the n-grams with a count below min_count.
+    If the smoothed model is given, it is derived again from the decayed counts.
+    Returns the number of removed n-grams."""
+
+    removed = 0
+
+    def decay_node(node, depth):
+        nonlocal removed
+
+        for c in list(node):
+            if depth < N - 1:
+                # inner node: decay the children and remove the node if nothing is left
+                decay_node(node[c], depth + 1)
+                if not node[c]:
+                    del node[c]
+                continue
+
+            # counts in the tree are stored with an offset of one (laplace smoothing)
+            count = (node[c] - 1) * factor
+            if min_count is not None and count < min_count:
+                del node[c]
+                removed += 1
+            else:
+                node[c] = count + 1
+
+    decay_node(model, 0)
+
+    # the smoothed model keeps its identity, so everybody holding it sees the new counts
+    if smoothed is not None:
+        smoothed.update(smooth_model(model, alphabet_base, N, smoothed['smoothing'], smoothed['backoff_factor']))
+
+    return removed
+
+
+def kneser_ney_discounts(table):
+    """Estimate the modified Kneser-Ney discounts D1, D2 and D3+ of one order from its count-of-counts"""
+
+    # count how many n-grams have been seen exactly 1, 2, 3 and 4 times
+    n = [0] * 5
+    for node in table.values():
+        for count in node.values():
+            if 1 <= count < 5:
+                n[int(count)] += 1
+
+    # fall back to fixed discounts if the counts are too sparse for the estimate (Chen & Goodman)
+    if not all(n[1:]):
+        return 0, 0.5, 1.0, 1.5
+
+    y = n[1] / (n[1] + 2 * n[2])
+    d1 = 1 - 2 * y * n[2] / n[1]
+    d2 = 2 - 3 * y * n[3] / n[2]
+    d3 = 3 - 4 * y * n[4] / n[3]
+
+    # a discount must never take away more than the count itself
+    return 0, min(max(d1, 0), 1), min(max(d2, 0), 2), min(max(d3, 0), 3)
+
+
+def discounted(count, discounts):
+    """Get the count minus its discount (D1 for counts up to one, which may be fractional after decay)"""
+
+    return max(count - discounts[min(int(count), 3) or 1], 0) if count > 0 else 0
+
+
+def add_ngram_counts(counts, continuations, prefix, last, count):
+    """Add count to all suffixes of the n-gram prefix + last in the per-order count tables"""
+
+    N = len(counts)
+
+    # from the highest to the lowest order
+    for k in range(N - 1, -1, -1):
+        history = prefix[N - 1 - k:]
+        counts_node = counts[k].setdefault(history, {})
+        is_new = last not in counts_node
+        counts_node[last] = counts_node.get(last, 0) + count
+
+        # an n-gram seen for the first time is a new left context of its lower order suffix
+        if k > 0 and is_new:
+            cont_node = continuations[k - 1].setdefault(history[1:], {})
+            cont_node[last] = cont_node.get(last, 0) + 1
+
+
+def table_node(smoothed, k, history):
+    """Get the counts the smoothed model uses for history at order k + 1"""
+
+    # kneser-ney uses continuation counts for the lower orders, except for histories at the sentence start
+    # (they are always preceded by the start symbol, so their continuation count is meaningless)
+    if smoothed['smoothing'] == 'kneser-ney' and k < smoothed['N'] - 1 and not (history and history[0] == START_ID):
+        return smoothed['continuations'][k].get(history)
+
+    return smoothed['counts'][k].get(history)
+
+
+def set_table_entry(smoothed, k, history):
+    """Precompute the denominator and the interpolation weight of the lower order for history at order k + 1"""
+
+    smoothing = smoothed['smoothing']
+    node = table_node(smoothed, k, history)
+
+    # history has been removed from the counts
+    if not node:
+        smoothed['tables'][k].pop(history, None)
+        return
+
+    total = sum(node.values())
+
+    if smoothing == 'kneser-ney':
+        denominator = total
+        gamma = 1 - sum(discounted(c, smoothed['discounts'][k]) for c in node.values()) / total
+    elif smoothing == 'witten-bell':
+        denominator = total + len(node)
+        gamma = len(node) / denominator
+    elif smoothing == 'stupid-backoff':
+        denominator = total
+        gamma = smoothed['backoff_factor']
+    else:
+        raise ValueError(f'Unknown smoothing method: {smoothing}')
+
+    smoothed['tables'][k][history] = (node, denominator, gamma)
+
+
+def smooth_model(model, alphabet_base, N, smoothing='kneser-ney', backoff_factor=0.4):
+    """Derive the per-order tables of a smoothed model from the count tree in one pass.
+    The result can be passed to get_prob, eval_model and generate_text."""
+
+    # counts[k] maps every history of length k to a dict {token: count} of the n-grams of order k + 1
+    counts = [dict() for _ in range(N)]
+    # continuations[k] maps every history of length k to a dict {token: number of distinct tokens preceding it}
+    continuations = [dict() for _ in range(N)]
+
+    # walk through the count tree, every leaf is one n-gram of the highest order
+    stack = [((), model)]
+    while stack:
+        prefix, node = stack.pop()
+
+        # inner node: descend into the children
+        if len(prefix) < N - 1:
+            for c, child in node.items():
+                stack.append((prefix + (c,), child))
+            continue
+
+        for last, value in node.items():
+            # counts in the tree are stored with an offset of one (laplace smoothing)
+            add_ngram_counts(counts, continuations, prefix, last, value - 1)
+
+    smoothed = {
+        'smoothing': smoothing,
+        'N': N,
+        'vocabulary': list(alphabet_base),
+        'counts': counts,
+        'continuations': continuations,
+        'tables': [dict() for _ in range(N)],
+        'discounts': [(0, 0, 0, 0)] * N,
+        'backoff_factor': backoff_factor,
+    }
+
+    for k in range(N):
+        if smoothing == 'kneser-ney':
+            smoothed['discounts'][k] = kneser_ney_discounts(
+                {history: table_node(smoothed, k, history) for history in counts[k]})
+
+        for history in counts[k]:
+            set_table_entry(smoothed, k, history)
+
+    return smoothed
+
+
+def pad_history(history, N):
+    """Cut the history to its last N - 1 tokens and pad it with start symbols if it is shorter"""
+
+    history = tuple(history)[len(history) - N + 1:] if N > 1 else ()
+    return (START_ID,) * (N - 1 - len(history)) + history
+
+
+def get_prob(smoothed, history, token):
+    """Get the (smoothed) probability of token following history, with one table lookup per order"""
+
+    N = smoothed['N']
+    history = pad_history(history, N)
+
+    if smoothed['smoothing'] == 'backoff':
+        return get_backoff_prob(smoothed, history, token)
+
+    tables = smoothed['tables']
+
+    if smoothed['smoothing'] == 'stupid-backoff':
+        # go from the highest order down and use the first relative frequency found
+        weight = 1
+        for k in range(N - 1, -1, -1):
+            entry = tables[k].get(history[N - 1 - k:])
+            if entry is not None and entry[0].get(token, 0) > 0:
+                return weight * entry[0][token] / entry[1]
+            weight *= smoothed['backoff_factor']
+
+        # token has never been seen at all
+        return weight / len(smoothed['vocabulary'])
+
+    return get_interpolated_prob(smoothed, history, token)
 
-    return model, alphabet_base
 
+def get_interpolated_prob(smoothed, history, token):
+    """Get the probability of token following history (of at most N - 1 tokens) from an interpolated model"""
 
-def generate_text(model, alphabet_base, N, start):
-    """Generate text from the n-gram model"""
+    tables = smoothed['tables']
+    discounts = smoothed['discounts']
+
+    # interpolate from the uniform distribution up to the order of the history
+    prob = 1 / len(smoothed['vocabulary'])
+    for k in range(len(history) + 1):
+        entry = tables[k].get(history[len(history) - k:])
+
+        # if a history was never seen, no longer history can have been seen either
+        if entry is None:
+            break
+
+        node, denominator, gamma = entry
+        count = node.get(token, 0)
+        prob = discounted(count, discounts[k]) / denominator + gamma * prob
+
+    return prob
+
+
+def get_distribution(smoothed, history):
+    """Get the weights of all tokens in the vocabulary following history"""
+
+    N = smoothed['N']
+    history = pad_history(history, N)
+
+    # start with the uniform distribution and refine it order by order
+    weights = dict.fromkeys(smoothed['vocabulary'], 1 / len(smoothed['vocabulary']))
+
+    if smoothed['smoothing'] == 'backoff':
+        for k in range(N):
+            explicit = smoothed['probs'][k].get(history[N - 1 - k:])
+            if explicit is not None:
+                # tokens without an explicit probability back off to the lower order
+                bow = smoothed['bows'][k][history[N - 1 - k:]]
+                weights = {token: weight * bow for token, weight in weights.items()}
+                weights.update(explicit)
+
+        return weights
+
+    tables = smoothed['tables']
+    discounts = smoothed['discounts']
+    for k in range(N):
+        entry = tables[k].get(history[N - 1 - k:])
+        if entry is None:
+            if smoothed['smoothing'] == 'stupid-backoff':
+                weights = {token: weight * smoothed['backoff_factor'] for token, weight in weights.items()}
+                continue
+            break
+
+        node, denominator, gamma = entry
+        weights = {token: weight * gamma for token, weight in weights.items()}
+        for token, count in node.items():
+            if smoothed['smoothing'] == 'stupid-backoff':
+                # the relative frequency of a seen token replaces the backed off score
+                if count > 0:
+                    weights[token] = count / denominator
+            else:
+                weights[token] += discounted(count, discounts[k]) / denominator
+
+    return weights
+
+
+def to_backoff_model(smoothed):
+    """Convert an interpolated smoothed model to a backoff model (like an ARPA file): every seen n-gram gets its
+    explicit probability and every history a backoff weight for all other tokens. Returns a new model which
+    can be pruned and used like the smoothed model, but not updated any more."""
+
+    if smoothed['smoothing'] not in ('kneser-ney', 'witten-bell'):
+        raise ValueError(f'Only interpolated models can be converted, not {smoothed["smoothing"]}')
+
+    N = smoothed['N']
+    probs = [dict() for _ in range(N)]
+    bows = [dict() for _ in range(N)]
+
+    for k in range(N):
+        for history, (node, denominator, gamma) in smoothed['tables'][k].items():
+            probs[k][history] = {token: get_interpolated_prob(smoothed, history, token)
+                                 for token, count in node.items() if count > 0}
+
+            # for an interpolated model, p(w | h) = gamma(h) * p(w | h') for every unseen w,
+            # so the backoff weight is exactly the interpolation weight
+            bows[k][history] = gamma
+
+    return {
+        'smoothing': 'backoff',
+        'N': N,
+        'vocabulary': smoothed['vocabulary'],
+        'counts': smoothed['counts'],
+        'probs': probs,
+        'bows': bows,
+    }
+
+
+def get_backoff_prob(backoff, history, token):
+    """Get the probability of token following history (of at most N - 1 tokens) from a backoff model"""
+
+    weight = 1
+    for k in range(len(history), -1, -1):
+        h = history[len(history) - k:]
+        explicit = backoff['probs'][k].get(h)
+
+        # an unseen history has a backoff weight of one
+        if explicit is not None:
+            prob = explicit.get(token)
+            if prob is not None:
+                return weight * prob
+            weight *= backoff['bows'][k][h]
+
+    # token has never been seen at all
+    return weight / len(backoff['vocabulary'])
+
+
+def model_size(backoff):
+    """Get the number of explicitly stored n-grams of a backoff model"""
+
+    return sum(len(explicit) for table in backoff['probs'] for explicit in table.values())
+
+
+def recompute_backoff_weights(backoff):
+    """Normalize the backoff model again after n-grams have been removed (from the lowest to the highest order,
+    because the weights depend on the lower order probabilities). The explicit probabilities stay unchanged."""
+
+    for k in range(1, backoff['N']):
+        for history in list(backoff['probs'][k]):
+            explicit = backoff['probs'][k][history]
+
+            # a history without explicit probabilities backs off with weight one, so it can be removed
+            if not explicit:
+                del backoff['probs'][k][history]
+                del backoff['bows'][k][history]
+                continue
+
+            # the left over probability mass is distributed according to the lower order
+            numerator = 1 - sum(explicit.values())
+            denominator = 1 - sum(get_backoff_prob(backoff, history[1:], token) for token in explicit)
+            backoff['bows'][k][history] = max(numerator, 0) / denominator if denominator > 0 else 1
+
+
+def copy_backoff_model(backoff):
+    """Copy the tables of a backoff model, so the copy can be pruned"""
+
+    backoff = dict(backoff)
+    backoff['probs'] = [{history: dict(explicit) for history, explicit in table.items()} for table in backoff['probs']]
+    backoff['bows'] = [dict(table) for table in backoff['bows']]
+    return backoff
+
+
+def prune_counts(backoff, cutoffs):
+    """Remove all n-grams of order n with a count below cutoffs[n - 1] (unigrams are never removed).
+    Returns the pruned copy of the backoff model."""
+
+    backoff = copy_backoff_model(backoff)
+
+    for k in range(1, min(backoff['N'], len(cutoffs))):
+        for history, explicit in backoff['probs'][k].items():
+            counts = backoff['counts'][k][history]
+            for token in [token for token in explicit if counts[token] < cutoffs[k]]:
+                del explicit[token]
+
+    recompute_backoff_weights(backoff)
+    return backoff
+
+
+def prune_entropy(backoff, target_size):
+    """Relative entropy pruning (Stolcke): remove the n-grams whose removal changes the model the least,
+    until at most target_size n-grams are left (unigrams are never removed).
+    Returns the pruned copy of the backoff model."""
+
+    N = backoff['N']
+
+    # probability of every history, computed by the chain rule (sentence start padding has probability one)
+    history_probs = {(): 1}
+
+    def history_prob(history):
+        prob = history_probs.get(history)
+        if prob is None:
+            prefix = history[:-1]
+            prob = history_prob(prefix)
+            if history[-1] != START_ID:
+                prob *= get_backoff_prob(backoff, prefix, history[-1])
+            history_probs[history] = prob
+
+        return prob
+
+    # increase of the relative entropy to the original model if an n-gram is removed on its own
+    entropy_changes = []
+    for k in range(1, N):
+        for history, explicit in backoff['probs'][k].items():
+            bow = backoff['bows'][k][history]
+            lower_probs = {token: get_backoff_prob(backoff, history[1:], token) for token in explicit}
+
+            # probability mass of all tokens that back off
+            numerator = 1 - sum(explicit.values())
+            denominator = 1 - sum(lower_probs.values())
+            weight = history_prob(history)
+
+            for token, prob in explicit.items():
+                # backoff weight of history if token was removed as well
+                new_bow = (numerator + prob) / (denominator + lower_probs[token])
+
+                # token now backs off, and all tokens that backed off before get the new backoff weight
+                change = prob * (math.log(lower_probs[token]) + math.log(new_bow) - math.log(prob))
+                if numerator > 0 and bow > 0:
+                    change += numerator * (math.log(new_bow) - math.log(bow))
+
+                entropy_changes.append((-weight * change, k, history, token))
+
+    # remove the n-grams with the smallest change until the model is small enough
+    backoff = copy_backoff_model(backoff)
+    entropy_changes.sort(key=lambda entry: entry[0])
+    to_remove = max(model_size(backoff) - target_size, 0)
+
+    for _, k, history, token in entropy_changes[:to_remove]:
+        del backoff['probs'][k][history][token]
+
+    recompute_backoff_weights(backoff)
+    return backoff
+
+
+def compile_model(backoff):
+    """Compile a backoff model into a flat query structure for fast scoring: every history gets an integer
+    context id, and histories, explicit n-grams and backoff weights are looked up by integer keys
+    (context id * vocabulary size + token id) and arrays, all probabilities as log2."""
+
+    N = backoff['N']
+    # size of the key space of the token ids, larger ids can't be in the model
+    V = 1 + max(max(backoff['vocabulary']), START_ID, END_ID, UNKNOWN_ID)
+
+    # context 0 is the empty history, longer histories are children of their suffix without the oldest token
+    contexts = {(): 0}
+    children = dict()  # context id * V + older token -> context id
+    parents = array('l', [0])  # context id -> context id of the history without the oldest token
+
+    def context_id(history):
+        context = contexts.get(history)
+        if context is None:
+            # every suffix of a history needs a context, so a lookup can walk from the newest token backwards
+            parent = context_id(history[1:])
+            context = contexts[history] = len(parents)
+            children[parent * V + history[0]] = context
+            parents.append(parent)
+
+        return context
+
+    entries = dict()  # context id * V + token id -> log2 probability
+    for k in range(N):
+        for history, explicit in backoff['probs'][k].items():
+            context = context_id(history)
+            for token, prob in explicit.items():
+                entries[context * V + token] = math.log2(prob)
+
+    # log2 backoff weights, a context without explicit probabilities has weight one
+    bows = array('d', [0.0]) * len(parents)
+    for k in range(N):
+        for history, bow in backoff['bows'][k].items():
+            bows[contexts[history]] = math.log2(bow) if bow > 0 else float('-inf')
+
+    return {
+        'N': N,
+        'V': V,
+        'children': children,
+        'parents': parents,
+        'entries': entries,
+        'bows': bows,
+        'unseen_log_prob': -math.log2(len(backoff['vocabulary'])),  # uniform distribution below the unigrams
+    }
+
+
+def score_ids(compiled, ids):
+    """Get the log2 probabilities of all token ids of a line and the end symbol"""
+
+    N, V = compiled['N'], compiled['V']
+    children, parents, entries, bows = compiled['children'], compiled['parents'], compiled['entries'], compiled['bows']
+
+    history = [START_ID] * (N - 1)
+    log_probs = []
+
+    for token in ids + [END_ID]:
+        # ids the model can't know are unknown
+        if token >= V:
+            token = UNKNOWN_ID
+
+        # find the context of the longest known history, from the newest token backwards
+        context = 0
+        for c in reversed(history):
+            child = children.get(context * V + c)
+            if child is None:
+                break
+            context = child
+
+        # back off until an explicit probability is found
+        log_prob = 0
+        while True:
+            entry = entries.get(context * V + token)
+            if entry is not None:
+                log_prob += entry
+                break
+
+            log_prob += bows[context]
+            if context == 0:
+                log_prob += compiled['unseen_log_prob']
+                break
+            context = parents[context]
+
+        log_probs.append(log_prob)
+
+        # for next iteration, remove first token and append the token
+        if N > 1:
+            history.append(token)
+            del history[0]
+
+    return log_probs
+
+
+def score_lines(compiled, lines, tokenizer, per_token=False):
+    """Score many lines, yields a dict with the line, its log2 probability and its number of tokens
+    (including the end symbol) per line, plus the log2 probability of every token if per_token is True"""
+
+    for line in lines:
+        line = line.rstrip('\n')
+        ids = tokenizer.encode(line.strip())
+        log_probs = score_ids(compiled, ids)
+
+        score = {'text': line, 'log_prob': sum(log_probs), 'tokens': len(log_probs)}
+        if per_token:
+            score['token_log_probs'] = [[tokenizer.vocabulary[token], log_prob]
+                                        for token, log_prob in zip(ids + [END_ID], log_probs)]
+
+        yield score
+
+
+def generate_text(model, alphabet_base, N, start, tokenizer, smoothed=None, max_length=None):
+    """Generate token ids from the n-gram model (at most max_length if given)"""
     
     # create start prefix (as list)
-    prefix = [START_SYMBOL] * (N - 1) + list(start)
-    prefix = prefix[-(N - 1):]
+    prefix = [START_ID] * (N - 1) + tokenizer.encode(start)
+    prefix = prefix[-(N - 1):] if N > 1 else []
 
     # loop as long as the end symbol is not found
-    while True:
-        # get the base node (node that represents the prefix)
-        base_node = get_base_node(model, prefix)
-
-        # insert into the alphabet base probabilities the probabilities of the base node create a copy of
-        # alphabet_base and update it with the base node the effect of this is that all characters that are not in
-        # the base node but in the alphabet base will have a weight of 1 (laplace smoothing)
-        node = alphabet_base.copy()
-        node.update(base_node)
-
-        # next character is chosen randomly based on the weights
-        chars, counts = zip(*node.items())
-        char = random.choices(chars, weights=counts)[0]
+    length = 0
+    while max_length is None or length < max_length:
+        if smoothed is not None:
+            # weights of all tokens given the prefix from the smoothed model
+            node = get_distribution(smoothed, prefix)
+        else:
+            # get the base node (node that represents the prefix)
+            base_node = get_base_node(model, prefix)
+
+            # insert into the alphabet base probabilities the probabilities of the base node create a copy of
+            # alphabet_base and update it with the base node the effect of this is that all tokens that are
+            # not in the base node but in the alphabet base will have a weight of 1 (laplace smoothing)
+            node = alphabet_base.copy()
+            node.update(base_node)
+
+        # next token is chosen randomly based on the weights
+        tokens, counts = zip(*node.items())
+        token = random.choices(tokens, weights=counts)[0]
 
         # break if end symbol is found
-        if char == END_SYMBOL:
+        if token == END_ID:
             break
 
-        # yield generated character
-        yield char
+        # yield generated token
+        yield token
+        length += 1
 
-        # for next iteration, remove first character and append generated character
-        prefix = prefix[1:] + [char]
+        # for next iteration, remove first token and append generated token
+        prefix = (prefix + [token])[1:] if N > 1 else []
 
 
-def eval_model(model, alphabet_base, test_source, N):
+def eval_model(model, alphabet_base, test_source, N, tokenizer, smoothed=None):
     """Evaluate the model by calculating the cross entropy and perplexity"""
 
     # sum of log probabilities and count of ngrams
@@ -111,22 +676,26 @@ def eval_model(model, alphabet_base, test_source, N):
 
     # open test source file and loop through all ngrams
     with open(test_source, 'r', encoding='utf-8') as f:
-        for ngram in ngrams_from_text(f, N):
-            # get base node for prefix
-            node = get_base_node(model, ngram[:-1])
+        for ngram in ngrams_from_text(f, N, tokenizer):
+            if smoothed is not None:
+                # add log probability of the smoothed model to sum
+                log_prob += math.log2(get_prob(smoothed, ngram[:-1], ngram[-1]))
+            else:
+                # get base node for prefix
+                node = get_base_node(model, ngram[:-1])
 
-            # get count of last character (weight is 1 if not in node (laplace smoothing))
-            count = node.get(ngram[-1], 1)
+                # get count of last token (weight is 1 if not in node (laplace smoothing))
+                count = node.get(ngram[-1], 1)
 
-            # add log probability to sum (with laplace smoothing)
-            weight_sum = sum(node.values()) + len(alphabet_base) - len(node)
-            log_prob += math.log2(count / weight_sum)
+                # add log probability to sum (with laplace smoothing)
+                weight_sum = sum(node.values()) + len(alphabet_base) - len(node)
+                log_prob += math.log2(count / weight_sum)
 
             # increase ngram count by one
             ngram_count += 1
 
-    # calculate cross entropy and perplexity
-    cross_entropy = log_prob / ngram_count
+    # calculate cross entropy (negative average log probability) and perplexity
+    cross_entropy = -log_prob / ngram_count
     perplexity = 2 ** cross_entropy
 
     return cross_entropy, perplexity
@@ -135,21 +704,86 @@ def eval_model(model, alphabet_base, test_source, N):
 def main(args):
     random.seed(args.random_seed)
 
+    # create the tokenizer, the byte-pair tokenizer has to learn its merges on the source first
+    tokenizer = TOKENIZERS[args.tokenizer]() if args.tokenizer != 'bpe' else TOKENIZERS['bpe'](args.bpe_merges)
+    with open(args.source, 'r', encoding='utf-8') as f:
+        tokenizer.fit(f)
+
     # build the model to be used for generation
-    model, alphabet_base = build_model(args.source, args.N)
+    model, alphabet_base = build_model(args.source, args.N, tokenizer)
+
+    # derive the smoothed model from the counts (laplace smoothing works on the counts directly)
+    smoothed = None
+    if args.smoothing != 'laplace':
+        smoothed = smooth_model(model, alphabet_base, args.N, args.smoothing, args.backoff_factor)
 
     # if given, evaluate the model
     if args.test_source:
-        cross_entropy, perplexity = eval_model(model, alphabet_base, args.test_source, args.N)
+        cross_entropy, perplexity = eval_model(model, alphabet_base, args.test_source, args.N, tokenizer, smoothed)
         print(f'Cross entropy: {cross_entropy:.3f}')
         print(f'Perplexity: {perplexity:.3f}')
 
-    # print the user defined start
-    print(args.start, end='')
-
-    # print characters while generating
-    for c in generate_text(model, alphabet_base, args.N, args.start):
-        print(c, end='')
+    # prune the model and report the size/perplexity trade-off, the smallest model is used for generation
+    if args.prune_counts or args.prune_sizes:
+        smoothed = to_backoff_model(smoothed)
+        print(f'unpruned: {model_size(smoothed)} n-grams')
+        pruned_models = []
+        if args.prune_counts:
+            smoothed = prune_counts(smoothed, args.prune_counts)
+            pruned_models.append(('count cutoffs', smoothed))
+        for size in sorted(args.prune_sizes, reverse=True):
+            pruned_models.append((f'entropy pruning to {size}', prune_entropy(smoothed, size)))
+
+        for name, smoothed in pruned_models:
+            line = f'{name}: {model_size(smoothed)} n-grams'
+            if args.test_source:
+                cross_entropy, perplexity = eval_model(model, alphabet_base, args.test_source, args.N, tokenizer,
+                                                       smoothed)
+                line += f', cross entropy {cross_entropy:.3f}, perplexity {perplexity:.3f}'
+            print(line)
+
+    # score the lines of the score input and write one line of TSV or JSON per line instead of generating
+    if args.score:
+        compiled = compile_model(smoothed if smoothed['smoothing'] == 'backoff' else to_backoff_model(smoothed))
+        f = sys.stdin if args.score == '-' else open(args.score, 'r', encoding='utf-8')
+        with f:
+            for score in score_lines(compiled, f, tokenizer, args.per_token):
+                if args.score_format == 'json':
+                    print(json.dumps(score, ensure_ascii=False))
+                else:
+                    columns = [f'{score["log_prob"]:.4f}', str(score['tokens']), score['text']]
+                    if args.per_token:
+                        columns.append(' '.join(f'{log_prob:.4f}' for _, log_prob in score['token_log_probs']))
+                    print('\t'.join(columns))
+        return
+
+    # add the update sources batch by batch to the model, decaying the old counts before every batch
+    for update_source in args.update:
+        f = sys.stdin if update_source == '-' else open(update_source, 'r', encoding='utf-8')
+        with f:
+            while True:
+                batch = list(itertools.islice(f, args.batch_lines))
+                if not batch:
+                    break
+
+                if args.decay != 1 or args.min_count is not None:
+                    decay_model(model, alphabet_base, args.N, args.decay, args.min_count, smoothed)
+                update_model(model, alphabet_base, batch, args.N, tokenizer, smoothed)
+
+                # evaluate the updated model
+                if args.test_source:
+                    cross_entropy, perplexity = eval_model(model, alphabet_base, args.test_source, args.N,
+                                                           tokenizer, smoothed)
+                    print(f'Added {len(batch)} lines of {update_source}: cross entropy {cross_entropy:.3f}, '
+                          f'perplexity {perplexity:.3f}')
+
+    # print the user defined start (separated from the generated text if the tokens are words)
+    print(args.start + (tokenizer.separator if args.start else ''), end='')
+
+    # print tokens while generating
+    for token in generate_text(model, alphabet_base, args.N, args.start, tokenizer, smoothed,
+                               args.max_length):
+        print(tokenizer.piece(token), end='')
 
 
 if __name__ == '__main__':
@@ -162,8 +796,46 @@ if __name__ == '__main__':
     parser.add_argument('--start', type=str, default='', required=False, help='Beginning of the generated text')
     parser.add_argument('--test-source', type=str, required=False, help='Test input text file. If given, the cross '
                                                                         'entropy and perplexity is calculated')
+    parser.add_argument('--smoothing', type=str, default='laplace',
+                        choices=['laplace', 'kneser-ney', 'witten-bell', 'stupid-backoff'],
+                        help='Smoothing method. Stupid backoff does not yield a normalized distribution, so its '
+                             'perplexity is only an approximation')
+    parser.add_argument('--backoff-factor', type=float, default=0.4, help='Backoff factor of stupid backoff')
+    parser.add_argument('--tokenizer', type=str, default='char', choices=list(TOKENIZERS),
+                        help='Tokens of the model: characters, whitespace separated words or byte-pair subwords')
+    parser.add_argument('--max-length', type=int, default=1000,
+                        help='Maximum number of generated tokens (laplace smoothing over a large vocabulary '
+                             'rarely generates the end symbol)')
+    parser.add_argument('--update', type=str, nargs='*', default=[],
+                        help='Text files (- for stdin) added to the model after it has been built, the model is '
+                             'evaluated on the test source after every batch')
+    parser.add_argument('--batch-lines', type=int, default=1000, help='Number of lines of an update batch')
+    parser.add_argument('--decay', type=float, default=1.0,
+                        help='Factor the old counts are multiplied with before every update batch')
+    parser.add_argument('--min-count', type=float, required=False,
+                        help='Remove n-grams whose count has decayed below this value before every update batch')
+    parser.add_argument('--prune-counts', type=float, nargs='+', default=[],
+                        help='Minimum count of the n-grams of each order (starting with unigrams, which are never '
+                             'removed)')
+    parser.add_argument('--prune-sizes', type=int, nargs='+', default=[],
+                        help='Target numbers of n-grams for relative entropy pruning, the perplexity of each '
+                             'pruned model is reported')
+    parser.add_argument('--score', type=str, required=False,
+                        help='Text file (- for stdin) whose lines are scored with the model instead of generating '
+                             'text, writes log2 probability, number of tokens and line per line')
+    parser.add_argument('--score-format', type=str, default='tsv', choices=['tsv', 'json'],
+                        help='Output format of the scores')
+    parser.add_argument('--per-token', action='store_true', help='Add the log2 probability of every token')
+    parser.add_argument('--bpe-merges', type=int, default=1000, help='Number of merges of the byte-pair tokenizer')
 
     args = parser.parse_args()
 
+    if (args.prune_counts or args.prune_sizes) and args.smoothing not in ('kneser-ney', 'witten-bell'):
+        parser.error('pruning needs an interpolated model (kneser-ney or witten-bell smoothing)')
+    if args.score and args.smoothing not in ('kneser-ney', 'witten-bell'):
+        parser.error('scoring needs an interpolated model (kneser-ney or witten-bell smoothing)')
+    if (args.prune_counts or args.prune_sizes or args.score) and args.update:
+        parser.error('pruned and compiled models can not be updated')
+
     # start program
     main(args)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from vocabulary import Vocabulary
+
+# define constants, the special symbols always have the same ids
+START_SYMBOL = "<s>"
+END_SYMBOL = "</s>"
+UNKNOWN_SYMBOL = "<unk>"
+START_ID = 0
+END_ID = 1
+UNKNOWN_ID = 2
+
+# marker appended to the last subword of every word by the byte-pair tokenizer
+END_OF_WORD = "</w>"
+
+
+class Tokenizer:
+    """Base class of all tokenizers: splits lines into symbols and maps them to integer ids.
+    Ids are assigned in order of appearance, so they are stable across runs for the same input."""
+
+    name = None
+    separator = ''  # separates the pieces of the start text and the generated text
+
+    def __init__(self):
+        self.symbols = Vocabulary([START_SYMBOL, END_SYMBOL, UNKNOWN_SYMBOL])
+        self.vocabulary = self.symbols.symbols  # id -> symbol
+        self.symbol2id = self.symbols.ids  # symbol -> id
+
+    def split(self, line):
+        """Split a line into its symbols"""
+
+        raise NotImplementedError
+
+    def fit(self, lines):
+        """Learn the vocabulary from the training lines"""
+
+        for line in lines:
+            self.encode(line, add=True)
+
+        return self
+
+    def add_symbol(self, symbol):
+        """Add a symbol to the vocabulary if it is not in there yet and return its id"""
+
+        return self.symbols.add(symbol)
+
+    def encode(self, line, add=False):
+        """Convert a line to a list of token ids; unknown symbols are added to the vocabulary
+        if add is True and mapped to the unknown id otherwise"""
+
+        if add:
+            return [self.add_symbol(symbol) for symbol in self.split(line)]
+
+        return [self.symbol2id.get(symbol, UNKNOWN_ID) for symbol in self.split(line)]
+
+    def piece(self, token_id):
+        """Get the text of a single token id, pieces can be concatenated to get the text"""
+
+        return self.vocabulary[token_id]
+
+    def decode(self, ids):
+        """Convert a list of token ids back to text (start and end symbols are left out)"""
+
+        return ''.join(self.piece(i) for i in ids if i != START_ID and i != END_ID)
+
+
+class CharTokenizer(Tokenizer):
+    """Every character is a token"""
+
+    name = 'char'
+
+    def split(self, line):
+        return list(line)
+
+
+class WordTokenizer(Tokenizer):
+    """Every whitespace separated word is a token"""
+
+    name = 'word'
+    separator = ' '
+
+    def split(self, line):
+        return line.split()
+
+    def piece(self, token_id):
+        return self.vocabulary[token_id] + ' '
+
+    def decode(self, ids):
+        return super().decode(ids).rstrip(' ')
+
+
+class BPETokenizer(Tokenizer):
+    """Byte-pair encoding (Sennrich et al.): words are split into subwords
+    by merges of frequent symbol pairs learned on the training corpus"""
+
+    name = 'bpe'
+    separator = ' '
+
+    def __init__(self, merges=1000):
+        super().__init__()
+        self.num_merges = merges
+        self.merge_ranks = dict()  # (left, right) -> rank of the merge, lower ranks are applied first
+        self.cache = dict()  # word -> list of subwords
+
+    def fit(self, lines):
+        """Learn the merges from the training lines"""
+
+        # count the words of the corpus, every word starts out as its sequence of characters
+        word_counts = dict()
+        for line in lines:
+            for word in line.split():
+                word_counts[word] = word_counts.get(word, 0) + 1
+        words = [list(word[:-1]) + [word[-1] + END_OF_WORD] for word in word_counts]
+        counts = list(word_counts.values())
+
+        # count all adjacent symbol pairs and remember which words contain them
+        pair_counts = dict()
+        pair_words = dict()
+        for i, word in enumerate(words):
+            for pair in zip(word, word[1:]):
+                pair_counts[pair] = pair_counts.get(pair, 0) + counts[i]
+                pair_words.setdefault(pair, set()).add(i)
+
+        for rank in range(self.num_merges):
+            if not pair_counts:
+                break
+
+            # merge the most frequent pair (ties are broken by the pair itself to be deterministic)
+            best = max(pair_counts, key=lambda pair: (pair_counts[pair], pair))
+            if pair_counts[best] < 2:
+                break
+            self.merge_ranks[best] = rank
+            merged = best[0] + best[1]
+
+            # only the words containing the pair have to be updated
+            for i in pair_words.pop(best):
+                word = words[i]
+
+                # remove the pair counts of the old segmentation
+                for pair in zip(word, word[1:]):
+                    pair_counts[pair] -= counts[i]
+                    if pair_counts[pair] <= 0:
+                        del pair_counts[pair]
+
+                words[i] = word = self.merge_word(word, best, merged)
+
+                # add the pair counts of the new segmentation
+                for pair in zip(word, word[1:]):
+                    pair_counts[pair] = pair_counts.get(pair, 0) + counts[i]
+                    pair_words.setdefault(pair, set()).add(i)
+
+        # the vocabulary consists of all subwords of the segmented training words
+        for word in words:
+            for symbol in word:
+                self.add_symbol(symbol)
+
+        self.cache.clear()
+        return self
+
+    @staticmethod
+    def merge_word(word, pair, merged):
+        """Replace all occurrences of pair in the list of symbols word by merged"""
+
+        out = []
+        i = 0
+        while i < len(word):
+            if i < len(word) - 1 and word[i] == pair[0] and word[i + 1] == pair[1]:
+                out.append(merged)
+                i += 2
+            else:
+                out.append(word[i])
+                i += 1
+
+        return out
+
+    def split_word(self, word):
+        """Split a word into subwords by applying the learned merges in the order they were learned"""
+
+        subwords = self.cache.get(word)
+        if subwords is not None:
+            return subwords
+
+        subwords = list(word[:-1]) + [word[-1] + END_OF_WORD]
+        while len(subwords) > 1:
+            # find the pair that was merged first during training
+            pair = min(zip(subwords, subwords[1:]), key=lambda p: self.merge_ranks.get(p, float('inf')))
+            if pair not in self.merge_ranks:
+                break
+            subwords = self.merge_word(subwords, pair, pair[0] + pair[1])
+
+        self.cache[word] = subwords
+        return subwords
+
+    def split(self, line):
+        return [subword for word in line.split() for subword in self.split_word(word)]
+
+    def piece(self, token_id):
+        return self.vocabulary[token_id].replace(END_OF_WORD, ' ')
+
+    def decode(self, ids):
+        return super().decode(ids).rstrip(' ')
+
+
+# all tokenizers by their name
+TOKENIZERS = {tokenizer.name: tokenizer for tokenizer in (CharTokenizer, WordTokenizer, BPETokenizer)}
@@ -0,0 +1,148 @@
+import argparse
+import multiprocessing
+import numpy as np
+
+from reviews import HashingVectorizer, MISSING_LABEL, load, mark_negations
+
+
+# multinomial Naive Bayes on sparse count matrices (labels 0/1), the counts can be added in minibatches
+class NaiveBayes:
+
+    def __init__(self, n_features, alpha=1.0):
+        self.alpha = alpha
+        self.feature_counts = np.zeros((2, n_features))
+        self.class_counts = np.zeros(2)
+
+    def partial_fit(self, X, y):
+        for c in (0, 1):
+            self.feature_counts[c] += np.asarray(X[y == c].sum(axis=0)).reshape(-1)
+            self.class_counts[c] += (y == c).sum()
+        return self
+
+    def fit(self, X, y, **kwargs):
+        return self.partial_fit(X, y)
+
+    # return the difference of the log probabilities of class 1 and class 0 for every row
+    def decision_function(self, X):
+        smoothed = self.feature_counts + self.alpha
+        log_probs = np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))
+        log_priors = np.log(self.class_counts + 1) - np.log(self.class_counts.sum() + 2)
+        return X @ (log_probs[1] - log_probs[0]) + (log_priors[1] - log_priors[0])
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.int64)
+
+
+# linear classifier trained by minibatch SGD, subclasses define the update of a minibatch
+class LinearClassifier:
+
+    def __init__(self, n_features, learning_rate=0.1):
+        self.learning_rate = learning_rate
+        self.weights = np.zeros(n_features)
+        self.bias = 0.0
+
+    def decision_function(self, X):
+        return X @ self.weights + self.bias
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.int64)
+
+    # add X^T * row_weights to the weights, only the columns occurring in X are touched
+    def add_rows(self, X, row_weights):
+        X = X.tocsr()
+        np.add.at(self.weights, X.indices, X.data * np.repeat(row_weights, np.diff(X.indptr)))
+
+    # train epochs passes over the data in shuffled minibatches
+    def fit(self, X, y, epochs=5, batch_size=32, rng=None):
+        rng = rng or np.random.RandomState(0)
+        for _ in range(epochs):
+            order = rng.permutation(X.shape[0])
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                self.partial_fit(X[batch], y[batch])
+        return self
+
+
+# logistic regression with L2 regularization
+class LogisticRegression(LinearClassifier):
+
+    def __init__(self, n_features, learning_rate=1.0, l2=0.0):
+        super().__init__(n_features, learning_rate)
+        self.l2 = l2
+
+    def partial_fit(self, X, y):
+        probs = 1 / (1 + np.exp(-self.decision_function(X)))
+        error = (probs - y) / X.shape[0]
+        if self.l2:
+            self.weights *= 1 - self.learning_rate * self.l2
+        self.add_rows(X, -self.learning_rate * error)
+        self.bias -= self.learning_rate * error.sum()
+        return self
+
+
+# perceptron, all misclassified rows of a minibatch update the weights together
+class Perceptron(LinearClassifier):
+
+    def partial_fit(self, X, y):
+        signs = 2 * y - 1
+        wrong = signs * self.decision_function(X) <= 0
+        self.add_rows(X[wrong], self.learning_rate * signs[wrong])
+        self.bias += self.learning_rate * signs[wrong].sum()
+        return self
+
+
+CLASSIFIERS = {"naive-bayes": NaiveBayes, "logistic-regression": LogisticRegression, "perceptron": Perceptron}
+
+# data of the cross validation, inherited by the forked processes
+folds_data = {}
+
+
+def train_fold(fold):
+    X, y, folds, make_classifier, fit_args = (folds_data[key] for key in ("X", "y", "folds", "make_classifier", "fit_args"))
+    test = folds == fold
+    classifier = make_classifier().fit(X[~test], y[~test], **fit_args)
+    return (classifier.predict(X[test]) == y[test]).mean()
+
+
+# return the accuracy of every fold of a k-fold cross validation, the folds are trained in parallel
+def cross_validate(make_classifier, X, y, k=10, workers=1, fit_args=None, seed=0):
+    folds = np.random.RandomState(seed).permutation(X.shape[0]) % k
+    folds_data.update(X=X, y=y, folds=folds, make_classifier=make_classifier, fit_args=fit_args or {})
+    if workers > 1:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            return pool.map(train_fold, range(k))
+    return [train_fold(fold) for fold in range(k)]
+
+
+def main(args):
+    vectorizer = HashingVectorizer(args.features, (1, args.ngrams), preprocessor=mark_negations if args.negations else None)
+    X, y = load(args.file, vectorizer)
+    rated = y != MISSING_LABEL
+    X, y = X[rated], y[rated]
+
+    def make_classifier():
+        return CLASSIFIERS[args.classifier](X.shape[1])
+
+    fit_args = {} if args.classifier == "naive-bayes" else {"epochs": args.epochs}
+    accuracies = cross_validate(make_classifier, X, y, args.folds, args.workers, fit_args)
+    print("accuracies:", " ".join("%.3f" % accuracy for accuracy in accuracies))
+    print("mean accuracy: %.3f" % np.mean(accuracies))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cross validate a sentiment classifier on a Restaurant_Reviews file')
+    parser.add_argument('file', type=str, help='Review file (.tsv or .arff)')
+    parser.add_argument('--classifier', type=str, default='naive-bayes', choices=sorted(CLASSIFIERS),
+                        help='Classifier to train')
+    parser.add_argument('--folds', type=int, default=10, help='Number of folds of the cross validation')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of processes training folds in parallel')
+    parser.add_argument('--epochs', type=int, default=5, help='Passes over the training data (not for naive-bayes)')
+    parser.add_argument('--features', type=int, default=2 ** 20, help='Number of hashed features')
+    parser.add_argument('--ngrams', type=int, default=2, help='Maximal n-gram length')
+    parser.add_argument('--negations', action='store_true', help='Mark the negations with _NOT before featurizing')
+
+    args = parser.parse_args()
+
+    # start program
+    main(args)
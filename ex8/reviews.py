@@ -0,0 +1,163 @@
+import argparse
+import itertools
+import re
+import zlib
+import numpy as np
+import scipy.sparse
+
+# the negations replaced by _NOT in Restaurant_Reviews_negations_marked.arff: the contractions
+# anywhere, not and no (also at the end of a longer word, e.g. cannot) only before a space
+NEGATION = re.compile(r"(?:don|won|didn|isn|aren|haven|hasn)'t|(?:not|no)(?= )")
+NEGATION_MARK = "_NOT"
+
+TOKEN = re.compile(r"[\w']+")
+ARFF_VALUE = re.compile(r"^'((?:[^'\\]|\\.)*)',\s*(\S+)$|^([^,]*),\s*(\S+)$")
+ARFF_ESCAPE = re.compile(r"\\(.)")
+
+MISSING_LABEL = -1 # label of reviews without rating (? in ARFF)
+HASH_MULTIPLIER = np.uint64(0x100000001b3) # combines the token hashes of an n-gram
+
+
+# yield (review, label) pairs of a tab separated file with header (Review, Liked)
+def read_tsv(lines):
+    next(lines, None)
+    for line in lines:
+        line = line.rstrip("\n")
+        if line:
+            review, label = line.rsplit("\t", 1)
+            yield review, parse_label(label)
+
+
+def parse_label(label):
+    return MISSING_LABEL if label == "?" else int(label)
+
+
+# yield (review, label) pairs of the @data section of an ARFF file (quoted string, label)
+def read_arff(lines):
+    for line in lines:
+        if line.strip().lower() == "@data":
+            break
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("%"):
+            continue
+        match = ARFF_VALUE.match(line)
+        if match is None:
+            raise ValueError("invalid ARFF data line: %s" % line)
+        if match.group(1) is not None:
+            yield ARFF_ESCAPE.sub(r"\1", match.group(1)), parse_label(match.group(2))
+        else:
+            yield match.group(3), parse_label(match.group(4))
+
+
+# yield (review, label) pairs of a .tsv or .arff file, line by line
+def read_reviews(filename):
+    reader = read_arff if filename.endswith(".arff") else read_tsv
+    with open(filename, 'r') as f:
+        yield from reader(iter(f))
+
+
+# replace the negations of a review by _NOT, reproduces Restaurant_Reviews_negations_marked.arff
+def mark_negations(text):
+    return NEGATION.sub(NEGATION_MARK, text)
+
+
+# bag of n-grams whose features are hashed into n_features columns, so no vocabulary has to be kept;
+# only the hashes of the distinct tokens are stored, the n-gram hashes are combined with NumPy for all
+# documents of a batch at once
+class HashingVectorizer:
+
+    def __init__(self, n_features=2 ** 20, ngram_range=(1, 2), lowercase=True, preprocessor=None, binary=False):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.lowercase = lowercase
+        self.preprocessor = preprocessor
+        self.binary = binary
+        self.token_hashes = {}
+
+    def token_hash(self, token):
+        h = self.token_hashes.get(token)
+        if h is None:
+            h = self.token_hashes[token] = zlib.crc32(token.encode("utf-8"))
+        return h
+
+    # return the tokens of a text
+    def tokenize(self, text):
+        if self.preprocessor:
+            text = self.preprocessor(text)
+        if self.lowercase:
+            # lowercase everything but the negation mark
+            return [token if token == NEGATION_MARK else token.lower() for token in TOKEN.findall(text)]
+        return TOKEN.findall(text)
+
+    # return the n-gram counts of the texts as CSR matrix (one row per text)
+    def transform(self, texts):
+        lengths = []
+        hashes = []
+        for text in texts:
+            tokens = self.tokenize(text)
+            lengths.append(len(tokens))
+            hashes.extend(self.token_hash(token) for token in tokens)
+        lengths = np.array(lengths, dtype=np.int64)
+        hashes = np.array(hashes, dtype=np.uint64)
+        documents = np.repeat(np.arange(len(lengths)), lengths)
+
+        rows = []
+        columns = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            if len(hashes) < n:
+                break
+            # the n-grams starting at every position, those crossing a document boundary are dropped
+            combined = hashes[:len(hashes) - n + 1] + np.uint64(n)
+            for k in range(1, n):
+                combined = combined * HASH_MULTIPLIER + hashes[k:len(hashes) - n + 1 + k]
+            valid = documents[:len(hashes) - n + 1] == documents[n - 1:]
+            rows.append(documents[:len(hashes) - n + 1][valid])
+            columns.append((combined[valid] % np.uint64(self.n_features)).astype(np.int64))
+
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        columns = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+        # duplicate entries are summed by the conversion
+        X = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, columns)),
+                                    shape=(len(lengths), self.n_features))
+        if self.binary:
+            X.data[:] = 1
+        return X
+
+    # yield (CSR matrix, labels) for batches of batch_size (review, label) pairs
+    def transform_stream(self, reviews, batch_size=10000):
+        reviews = iter(reviews)
+        while True:
+            batch = list(itertools.islice(reviews, batch_size))
+            if not batch:
+                break
+            texts, labels = zip(*batch)
+            yield self.transform(texts), np.array(labels)
+
+
+# return the features and labels of a review file
+def load(filename, vectorizer):
+    batches = list(vectorizer.transform_stream(read_reviews(filename)))
+    if not batches:
+        return scipy.sparse.csr_matrix((0, vectorizer.n_features)), np.zeros(0, dtype=np.int64)
+    return scipy.sparse.vstack([X for X, _ in batches]).tocsr(), np.concatenate([y for _, y in batches])
+
+
+def main(args):
+    vectorizer = HashingVectorizer(args.features, (1, args.ngrams), preprocessor=mark_negations if args.negations else None)
+    X, y = load(args.file, vectorizer)
+    print("%d reviews, %d positive, %d negative, %d unlabeled, %d features, %d non-zero entries"
+          % (X.shape[0], (y == 1).sum(), (y == 0).sum(), (y == MISSING_LABEL).sum(), X.shape[1], X.nnz))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load and featurize a Restaurant_Reviews file')
+    parser.add_argument('file', type=str, help='Review file (.tsv or .arff)')
+    parser.add_argument('--features', type=int, default=2 ** 20, help='Number of hashed features')
+    parser.add_argument('--ngrams', type=int, default=2, help='Maximal n-gram length')
+    parser.add_argument('--negations', action='store_true', help='Mark the negations with _NOT before featurizing')
+
+    args = parser.parse_args()
+
+    # start program
+    main(args)
@@ -1,28 +1,58 @@
 #!/usr/bin/env python3
+import argparse
 import dynet as dy
+import os
+import sys
 import random
 import numpy as np
 import math
+from collections import OrderedDict
+
+from checkpoint import save_checkpoint, load_checkpoint, restore_parameters, load_vocabulary
+from parallel import parallel_rounds
+from softmax import FullSoftmax, ClassFactoredSoftmax
+from reporting import Reporter
+from quantized import save_quantized
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from readers import IndexedLineReader
 
 START_SYMBOL = "<s>"
 END_SYMBOL = "</s>"
 
+CHECKPOINT_FILE = "charnnlm.npz"
+CHECKPOINT_EVERY = 100 # batches
+QUANTIZED_FILE = "charnnlm.int8.npz" # the trained model for quantized.load_quantized
 
-data = open('input.txt', 'r').read() # should be simple plain text file
-characters = set(data)
-characters.add(START_SYMBOL)
-characters.add(END_SYMBOL)
-characters = list(characters)
-sentences = [x for x in data.splitlines() if x]
+
+# the non-empty lines of a simple plain text file, read from disk when they are needed
+corpus = IndexedLineReader('input.txt')
+# the vocabulary of a checkpoint has to be reused, otherwise the ids of the chars change
+characters = load_vocabulary(CHECKPOINT_FILE, corpus.symbols() | {START_SYMBOL, END_SYMBOL})
+sentences = list(range(len(corpus))) # the sentences are handled as line numbers of the corpus
 
 int2char = list(characters)
 char2int = {c:i for i,c in enumerate(characters)}
 
 MAX_EPOCHS = 5
+BATCH_SIZE = 32
+WORKERS = 1 # number of training processes, their parameters are averaged every SYNC_EVERY batches
+SYNC_EVERY = 10
 VOCAB_SIZE = len(characters)
 INPUT_DIM = 32
 HIDDEN_DIM = 64
 LAYERS = 2
+SOFTMAX = "full" # or "class" for a class-factored softmax, which costs about sqrt(VOCAB_SIZE) per char
+
+REPORT_EVERY = 1000 # sentences, every report prints loss and throughput as JSON line
+SAMPLE_EVERY = 1000 # sentences between generated samples
+DEV_EVERY = 5000 # sentences between evaluations of the dev perplexity
+DEV_SIZE = 200 # held-out sentences
+MAX_GENERATE_LENGTH = 200 # an undertrained model might never generate </s>
+
+# hold out DEV_SIZE sentences (in a fixed random order, so a resumed training gets the same split)
+random.Random(0).shuffle(sentences)
+sentences, dev_sentences = sentences[DEV_SIZE:], sentences[:DEV_SIZE]
 
 pc = dy.ParameterCollection()
 
@@ -31,91 +61,261 @@ rnn = dy.SimpleRNNBuilder(LAYERS, INPUT_DIM, HIDDEN_DIM, pc)
 
 params = {}
 params["lookup"] = pc.add_lookup_parameters((VOCAB_SIZE, INPUT_DIM))
-params["R"] = pc.add_parameters((VOCAB_SIZE, HIDDEN_DIM))
-params["bias"] = pc.add_parameters((VOCAB_SIZE))
+if SOFTMAX == "class":
+    # the classes are binned by how often each char has to be predicted
+    counts = [0] * VOCAB_SIZE
+    for sentence in corpus:
+        for c in list(sentence) + [END_SYMBOL]:
+            counts[char2int[c]] += 1
+    softmax = ClassFactoredSoftmax(pc, HIDDEN_DIM, counts)
+else:
+    params["R"] = pc.add_parameters((VOCAB_SIZE, HIDDEN_DIM))
+    params["bias"] = pc.add_parameters((VOCAB_SIZE))
+    softmax = FullSoftmax(params["R"], params["bias"])
 
+# values of the RNN state after reading <s> + prefix and output of its top layer, by prefix (least recently used first)
+STATE_CACHE_SIZE = 10000
+state_cache = OrderedDict()
 
-# return compute loss of RNN for one sentence
-def do_one_sentence(rnn, sentence):
-    # setup the sentence
+
+# an RNN state restored from the cache: a DyNet initial state has no output until it reads an input,
+# so the cached output is returned until the next char is read
+class RestoredState:
+
+    def __init__(self, state, output):
+        self.state = state
+        self.output_expression = output
+
+    def output(self):
+        return self.output_expression
+
+    def add_input(self, x):
+        return self.state.add_input(x)
+
+    def s(self):
+        return self.state.s()
+
+
+# return the summed loss of RNN for a batch of sentences and the number of predicted symbols
+def do_one_batch(rnn, batch):
+    # setup the batch, sorted by decreasing length so only the tail needs masking
     dy.renew_cg()
     s0 = rnn.initial_state()
 
-    R = params["R"]
-    bias = params["bias"]
     lookup = params["lookup"]
-    sentence = [START_SYMBOL] + list(sentence) + [END_SYMBOL]
-    sentence = [char2int[c] for c in sentence]
+    batch = sorted(batch, key=len, reverse=True)
+    batch = [[char2int[c] for c in [START_SYMBOL] + list(sentence) + [END_SYMBOL]] for sentence in batch]
+    max_len = len(batch[0])
+
     s = s0
     loss = []
-    for char,next_char in zip(sentence,sentence[1:]):
-        s = s.add_input(lookup[char])
-        probs = dy.softmax(R*s.output() + bias)
-        loss.append( -dy.log(dy.pick(probs,next_char)) )
+    symbols = 0
+    for i in range(max_len - 1):
+        # chars of all sentences at position i and i + 1, shorter sentences are padded with the end symbol
+        chars = [sentence[i] if i < len(sentence) else char2int[END_SYMBOL] for sentence in batch]
+        next_chars = [sentence[i + 1] if i + 1 < len(sentence) else char2int[END_SYMBOL] for sentence in batch]
+        mask = [1 if i + 1 < len(sentence) else 0 for sentence in batch]
+        symbols += sum(mask)
+
+        s = s.add_input(dy.lookup_batch(lookup, chars))
+        # the padded positions must not contribute to the loss
+        loss.append(softmax.neg_log_softmax_batch(s.output(), next_chars, mask))
     loss = dy.esum(loss)
-    return loss
+    return loss, symbols
 
 
-# generate from model:
-def generate(rnn):
-    # setup the sentence
+# split the sentences (line numbers) into batches of similar length (so there is little padding) in random order
+def make_batches(sentences, batch_size, rng=random):
+    sentences = sorted(sentences, key=corpus.length)
+    batches = [sentences[i:i + batch_size] for i in range(0, len(sentences), batch_size)]
+    rng.shuffle(batches)
+    return batches
+
+
+# return the RNN state (in the current graph) after reading <s> and prefix; it continues from the
+# state of the longest cached prefix and caches the state of prefix, so the next keystroke only has
+# to read one more char
+def state_after(rnn, prefix):
+    lookup = params["lookup"]
+
+    # find the longest cached prefix
+    i = len(prefix)
+    while i >= 0 and prefix[:i] not in state_cache:
+        i -= 1
+
+    if i >= 0:
+        state_cache.move_to_end(prefix[:i])
+        values, output = state_cache[prefix[:i]]
+        s = rnn.initial_state([dy.inputTensor(v) for v in values])
+        if i == len(prefix):
+            return RestoredState(s, dy.inputTensor(output))
+    else:
+        i = 0
+        s = rnn.initial_state().add_input(lookup[char2int[START_SYMBOL]])
+
+    for c in prefix[i:]:
+        s = s.add_input(lookup[char2int[c]])
+
+    # remember the values of all layers, dropping the least recently used prefix if the cache is full
+    state_cache[prefix] = [v.npvalue() for v in s.s()], s.output().npvalue()
+    if len(state_cache) > STATE_CACHE_SIZE:
+        state_cache.popitem(last=False)
+    return s
+
+
+# return the log2 probabilities of several continuations of the same prefix (with </s> appended if complete);
+# the prefix is read once and continuations sharing their beginning share its computation
+def score_continuations(rnn, prefix, continuations, complete=False):
     dy.renew_cg()
-    s0 = rnn.initial_state()
+    lookup = params["lookup"]
+
+    # state and loss of every beginning of a continuation, computed once
+    states = {(): state_after(rnn, prefix)}
+    losses = {(): dy.scalarInput(0)}
+    totals = []
+    for continuation in continuations:
+        symbols = tuple(continuation) + ((END_SYMBOL,) if complete else ())
+        for j, symbol in enumerate(symbols):
+            before, after = symbols[:j], symbols[:j + 1]
+            if after in losses:
+                continue
+            if before not in states:
+                states[before] = states[symbols[:j - 1]].add_input(lookup[char2int[symbols[j - 1]]])
+            # only the negative log-softmax of the needed char is used
+            losses[after] = losses[before] + softmax.neg_log_softmax(states[before].output(), char2int[symbol])
+        totals.append(losses[symbols])
 
-    R = params["R"]
-    bias = params["bias"]
+    # one forward pass for all continuations
+    return [-v / math.log(2) for v in dy.concatenate(totals).npvalue().reshape(-1)]
+
+
+# generate from model (continuing prefix if given, at most max_length chars):
+def generate(rnn, prefix="", max_length=MAX_GENERATE_LENGTH):
+    # setup the sentence
+    dy.renew_cg()
     lookup = params["lookup"]
 
-    s = s0
-    out=[START_SYMBOL]
-    lines_generated = 0
-    next_char = char2int[START_SYMBOL]
-    while out[-1] != END_SYMBOL:
-        s = s.add_input(lookup[next_char])
-        probs = dy.softmax(R*s.output() + bias)
-        probs = probs.npvalue()
-        next_char = np.random.choice(VOCAB_SIZE, p=probs/probs.sum())
+    s = state_after(rnn, prefix)
+    out = []
+    while len(out) < max_length:
+        # sample with the gumbel-max trick on the log probabilities, no renormalization needed
+        log_probs = softmax.log_distribution(s.output())
+        next_char = int(np.argmax(log_probs - np.log(-np.log(np.random.random_sample(VOCAB_SIZE)))))
+        if next_char == char2int[END_SYMBOL]:
+            break
         out.append(int2char[next_char])
-    return "".join(out[1:-1]) # strip the <s>/</s>
+        s = s.add_input(lookup[next_char])
+    return "".join(out)
 
 
 def assess(rnn, sentence):
-    dy.renew_cg()
-    crossentropy = 0
-    R = params["R"]
-    bias = params["bias"]
-    lookup = params["lookup"]
-    sentence = list(sentence) + [END_SYMBOL]
-    s = rnn.initial_state().add_input(lookup[char2int[START_SYMBOL]])
-    for symbol in sentence:
-        probs = dy.softmax(R*s.output() + bias)
-        probs = probs.npvalue()
-        prob = probs[char2int[symbol]]
-        #print("prob of {} is {}".format(symbol, prob))
-        crossentropy -= math.log2(prob)
-        s = s.add_input(lookup[char2int[symbol]])
-    return crossentropy / len(sentence), crossentropy, len(sentence)
-
-
-def multiple_train(trainer, rnn, sentences):
-    i = 1
-    aggr_loss = 0
-    aggr_symbols = 0
-    for sentence in sentences:
-        loss = do_one_sentence(rnn, sentence)
-        loss.backward()
-        loss_value = loss.value()
-        trainer.update()
-        aggr_loss += loss_value
-        aggr_symbols += len(sentence) + 1
-        if i % 1000 == 0:
-            print(i, aggr_loss/aggr_symbols, "\n\t", generate(rnn), "\n\t", assess(rnn, "His tender heir might bear his memory:"))
-            aggr_loss = 0
-            aggr_symbols = 0
-        i += 1
+    crossentropy = -score_continuations(rnn, "", [sentence], complete=True)[0]
+    return crossentropy / (len(sentence) + 1), crossentropy, len(sentence) + 1
+
+
+# check that states restored from the cache (fully or partly) give the same results as computed ones:
+# return the cross entropies of a sentence scored repeatedly and continued after a cached prefix, which
+# all have to be the same (generating from the cached prefix must not fail either)
+def check_state_cache(sentence):
+    state_cache.clear()
+    crossentropies = [assess(rnn, sentence)[1]]
+    for _ in range(2):
+        crossentropies.append(assess(rnn, sentence)[1])
+        continued = -score_continuations(rnn, "", [sentence[:3]])[0]
+        continued -= score_continuations(rnn, sentence[:3], [sentence[3:]], complete=True)[0]
+        crossentropies.append(continued)
+        generate(rnn, sentence[:3])
+    state_cache.clear()
+    return crossentropies
+
+
+# return the perplexity per char of the sentences (line numbers), computed in batches (without the state cache)
+def perplexity(rnn, sentences):
+    loss = 0
+    symbols = 0
+    for batch in make_batches(sentences, BATCH_SIZE):
+        batch_loss, batch_symbols = do_one_batch(rnn, [corpus[i] for i in batch])
+        loss += batch_loss.value()
+        symbols += batch_symbols
+    return math.exp(loss / symbols)
+
+
+def sample_hook(metrics):
+    # the cached states belong to the parameters before the updates
+    state_cache.clear()
+    return {"sample": generate(rnn)}
+
+
+def dev_hook(metrics):
+    return {"dev_ppl": perplexity(rnn, dev_sentences)}
+
+
+# train one batch, return its loss value and number of symbols
+def train_batch(trainer, batch):
+    loss, symbols = do_one_batch(rnn, [corpus[i] for i in batch])
+    loss_value = loss.value()
+    loss.backward()
+    trainer.update()
+    return loss_value, symbols
+
+
+def multiple_train(trainer, rnn, sentences, reporter, epoch=0, first_batch=0):
+    # the batch order only depends on the epoch, so a resumed epoch can skip the batches already trained
+    batches = make_batches(sentences, BATCH_SIZE, random.Random(epoch))
+    if WORKERS > 1:
+        # one step is a synchronized round of all workers
+        steps = parallel_rounds(pc, trainer, train_batch, batches, WORKERS, SYNC_EVERY, first_batch)
+    else:
+        steps = ((b + 1,) + train_batch(trainer, batches[b]) for b in range(first_batch, len(batches)))
+
+    done = first_batch
+    reporter.start(sum(len(batch) for batch in batches[:done]), epoch=epoch)
+    for b, loss_value, symbols in steps:
+        reporter.update(sum(len(batch) for batch in batches[done:b]), loss_value, symbols)
+        if b // CHECKPOINT_EVERY > done // CHECKPOINT_EVERY:
+            save_checkpoint(CHECKPOINT_FILE, pc, int2char, epoch, b)
+        done = b
+
+
+# export the parameters as int8 for the NumPy inference of quantized.py (only for the SimpleRNNBuilder)
+def export_quantized(filename):
+    arrays = softmax.arrays()
+    arrays["lookup"] = params["lookup"].as_array()
+    for l, (x2h, h2h, hb) in enumerate(rnn.get_parameters()):
+        arrays["x2h_%d" % l] = x2h.as_array()
+        arrays["h2h_%d" % l] = h2h.as_array()
+        arrays["hb_%d" % l] = hb.as_array()
+    save_quantized(filename, "rnn", arrays, int2char, layers=LAYERS)
+
+
+# continue from the last checkpoint if there is one (a finished training is just reloaded)
+first_epoch, first_batch = 0, 0
+if os.path.exists(CHECKPOINT_FILE):
+    checkpoint = load_checkpoint(CHECKPOINT_FILE)
+    restore_parameters(pc, checkpoint)
+    first_epoch, first_batch = checkpoint["epoch"], checkpoint["batch"]
+    print("resuming from", CHECKPOINT_FILE, "at epoch", first_epoch, "batch", first_batch)
+
+# with --check only the state cache is checked on the dev sentences (with the model of the checkpoint)
+parser = argparse.ArgumentParser(description='Train the char RNN LM on input.txt')
+parser.add_argument('--check', action='store_true', help='Check the state cache instead of training')
+args, _ = parser.parse_known_args() # the --dynet-* arguments are read by dynet
+if args.check:
+    failed = 0
+    for i in dev_sentences:
+        crossentropies = check_state_cache(corpus[i])
+        if not all(math.isclose(c, crossentropies[0], rel_tol=1e-4) for c in crossentropies):
+            print("state cache mismatch:", corpus[i], crossentropies)
+            failed += 1
+    print("state cache checked on", len(dev_sentences), "sentences,", failed, "failed")
+    sys.exit(1 if failed else 0)
 
+reporter = Reporter(REPORT_EVERY)
+reporter.add_hook(sample_hook, SAMPLE_EVERY)
+reporter.add_hook(dev_hook, DEV_EVERY)
 
 trainer = dy.SimpleSGDTrainer(pc)
-for _ in range(MAX_EPOCHS):
-    random.shuffle(sentences)
-    multiple_train(trainer, rnn, sentences)
+for epoch in range(first_epoch, MAX_EPOCHS):
+    multiple_train(trainer, rnn, sentences, reporter, epoch, first_batch if epoch == first_epoch else 0)
+    save_checkpoint(CHECKPOINT_FILE, pc, int2char, epoch + 1, 0)
+export_quantized(QUANTIZED_FILE)
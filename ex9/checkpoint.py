@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import os
+import numpy as np
+
+
+# return the values of all parameters of the ParameterCollection pc as dict of arrays
+def parameter_arrays(pc):
+    arrays = {}
+    for i, p in enumerate(pc.parameters_list()):
+        arrays["param_%d" % i] = p.as_array()
+    for i, p in enumerate(pc.lookup_parameters_list()):
+        arrays["lookup_%d" % i] = p.as_array()
+    return arrays
+
+
+# save all parameters of the ParameterCollection pc, the vocabulary (list of symbols, the index is the id)
+# and the training position (finished epochs and batches of the current epoch) to a single .npz file
+def save_checkpoint(filename, pc, vocabulary, epoch, batch):
+    arrays = parameter_arrays(pc)
+    arrays.update(vocabulary=np.array(vocabulary), epoch=np.array(epoch), batch=np.array(batch))
+
+    # write to a temporary file first, so an interrupted save never destroys the last checkpoint
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(filename + ".tmp", filename)
+
+
+# load a checkpoint saved by save_checkpoint, returns a dict of its arrays
+# (the vocabulary as list of symbols, epoch and batch as ints)
+def load_checkpoint(filename):
+    with np.load(filename) as f:
+        checkpoint = {name: f[name] for name in f.files}
+    checkpoint["vocabulary"] = checkpoint["vocabulary"].tolist()
+    checkpoint["epoch"] = int(checkpoint["epoch"])
+    checkpoint["batch"] = int(checkpoint["batch"])
+    return checkpoint
+
+
+# set the parameters of pc to the values of the checkpoint (or of parameter_arrays),
+# pc must have been built the same way
+def restore_parameters(pc, checkpoint):
+    for i, p in enumerate(pc.parameters_list()):
+        value = checkpoint["param_%d" % i]
+        if p.as_array().shape != value.shape:
+            raise ValueError("checkpoint parameter %d has shape %s instead of %s" % (i, value.shape, p.as_array().shape))
+        p.set_value(value)
+    for i, p in enumerate(pc.lookup_parameters_list()):
+        p.init_from_array(checkpoint["lookup_%d" % i])
+
+
+# return the vocabulary of the checkpoint if it exists, otherwise the sorted symbols of the data
+# (sorting makes the ids independent of the set iteration order)
+def load_vocabulary(filename, symbols):
+    if not os.path.exists(filename):
+        return sorted(symbols)
+
+    vocabulary = load_checkpoint(filename)["vocabulary"]
+    unknown = set(symbols) - set(vocabulary)
+    if unknown:
+        raise ValueError("the data contains symbols that are not in the vocabulary of %s: %s" % (filename, unknown))
+    return vocabulary
@@ -1,35 +1,76 @@
 #!/usr/bin/env python3
 import dynet as dy
+import os
+import sys
 import random
 import numpy as np
+import math
+
+from checkpoint import save_checkpoint, load_checkpoint, restore_parameters, load_vocabulary
+from parallel import parallel_rounds
+from softmax import FullSoftmax, ClassFactoredSoftmax
+from reporting import Reporter
+from quantized import save_quantized
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from readers import IndexedLineReader
 
 START_SYMBOL = "<s>"
 END_SYMBOL = "</s>"
 
-data = open('input.txt', 'r').read() # should be simple plain text file
-characters = set(data)
-characters.add(START_SYMBOL)
-characters.add(END_SYMBOL)
-characters = list(characters)
-sentences = [x for x in data.splitlines() if x]
+CHECKPOINT_FILE = "fixedcontextnn.npz"
+CHECKPOINT_EVERY = 100 # batches
+QUANTIZED_FILE = "fixedcontextnn.int8.npz" # the trained model for quantized.load_quantized
+
+# the non-empty lines of a simple plain text file, read from disk when they are needed
+corpus = IndexedLineReader('input.txt')
+# the vocabulary of a checkpoint has to be reused, otherwise the ids of the chars change
+characters = load_vocabulary(CHECKPOINT_FILE, corpus.symbols() | {START_SYMBOL, END_SYMBOL})
+sentences = list(range(len(corpus))) # the sentences are handled as line numbers of the corpus
 
 int2char = list(characters)
 char2int = {c:i for i, c in enumerate(characters)}
 
 MAX_EPOCHS = 5
+BATCH_SIZE = 64 # number of sentences whose n-grams are trained together
+WORKERS = 1 # number of training processes, their parameters are averaged every SYNC_EVERY batches
+SYNC_EVERY = 10
 VOCAB_SIZE = len(characters)
 INPUT_DIM = VOCAB_SIZE
 HIDDEN_DIM = 64
+SOFTMAX = "full" # or "class" for a class-factored softmax, which costs about sqrt(VOCAB_SIZE) per n-gram
 
 N = 7
 
+REPORT_EVERY = 1000 # sentences, every report prints loss and throughput as JSON line
+SAMPLE_EVERY = 1000 # sentences between generated samples
+DEV_EVERY = 5000 # sentences between evaluations of the dev perplexity
+DEV_SIZE = 200 # held-out sentences
+MAX_GENERATE_LENGTH = 200 # an undertrained model might never generate </s>
+
+# hold out DEV_SIZE sentences (in a fixed random order, so a resumed training gets the same split)
+random.Random(0).shuffle(sentences)
+sentences, dev_sentences = sentences[DEV_SIZE:], sentences[:DEV_SIZE]
+
 pc = dy.ParameterCollection()
 params = {}
 #params["lookup"] = pc.add_lookup_parameters((VOCAB_SIZE, INPUT_DIM))
-params["W1"] = pc.add_parameters((HIDDEN_DIM, (N - 1) * VOCAB_SIZE))
+# W1 multiplied with the concatenated one-hot vectors of the history is the sum of one column of W1 per history
+# position, so the columns are stored as rows of lookup parameters: column j * VOCAB_SIZE + c belongs to char c
+# at position j of the history
+params["W1"] = pc.add_lookup_parameters(((N - 1) * VOCAB_SIZE, HIDDEN_DIM))
 params["bias1"] = pc.add_parameters((HIDDEN_DIM,))
-params["W2"] = pc.add_parameters((VOCAB_SIZE, HIDDEN_DIM))
-params["bias2"] = pc.add_parameters((VOCAB_SIZE,))
+if SOFTMAX == "class":
+    # the classes are binned by how often each char has to be predicted
+    counts = [0] * VOCAB_SIZE
+    for sentence in corpus:
+        for c in list(sentence) + [END_SYMBOL]:
+            counts[char2int[c]] += 1
+    softmax = ClassFactoredSoftmax(pc, HIDDEN_DIM, counts)
+else:
+    params["W2"] = pc.add_parameters((VOCAB_SIZE, HIDDEN_DIM))
+    params["bias2"] = pc.add_parameters((VOCAB_SIZE,))
+    softmax = FullSoftmax(params["W2"], params["bias2"])
 
 
 # return the N-grams for the given sentence (as pairs, divided in history and symbol to be predicted)
@@ -42,79 +83,126 @@ def ngrams_from_sentence(sentence, N):
         prefix.pop(0)
 
 
-# return compute loss of RNN for one sentence
-def do_one_sentence(sentence):
-    # setup the sentence
+# return the input layer columns of W1 for a history (list of chars)
+def history_columns(history):
+    return [j * VOCAB_SIZE + char2int[c] for j, c in enumerate(history)]
+
+
+# return the summed loss for all n-grams of a batch of sentences and the number of n-grams
+def do_one_batch(sentences):
+    # setup the batch, every n-gram of every sentence is one element of the batch
     dy.renew_cg()
 
     W1 = params["W1"]
     bias1 = params["bias1"]
-    W2 = params["W2"]
-    bias2 = params["bias2"]
-    loss = []
-    for history,next_char in ngrams_from_sentence(sentence, N):
-        inputs = []
-        for c in history:
-            one_hot_vector = [0] * VOCAB_SIZE
-            one_hot_vector[char2int[c]] = 1
-            inputs.extend(one_hot_vector)
-        input_layer = dy.inputVector(inputs)
-        hidden_layer = dy.tanh(W1 * input_layer + bias1)
-        probs = dy.softmax(W2 * hidden_layer + bias2)
-        loss.append( -dy.log(dy.pick(probs,char2int[next_char])) )
-    loss = dy.esum(loss)
-    return loss
-
-
-# generate from model:
-def generate():
+    columns = []
+    next_chars = []
+    for sentence in sentences:
+        for history,next_char in ngrams_from_sentence(sentence, N):
+            columns.append(history_columns(history))
+            next_chars.append(char2int[next_char])
+
+    # sum the columns of W1 for all history positions at once
+    input_layer = dy.esum([dy.lookup_batch(W1, [c[j] for c in columns]) for j in range(N - 1)])
+    hidden_layer = dy.tanh(input_layer + bias1)
+    loss = softmax.neg_log_softmax_batch(hidden_layer, next_chars)
+    return loss, len(next_chars)
+
+
+# generate from model (at most max_length chars):
+def generate(max_length=MAX_GENERATE_LENGTH):
     # setup the sentence
     dy.renew_cg()
 
     W1 = params["W1"]
     bias1 = params["bias1"]
-    W2 = params["W2"]
-    bias2 = params["bias2"]
     history = [START_SYMBOL] * (N-1)
-    out=["<s>"]
-
-    while out[-1] != END_SYMBOL:
-        inputs = []
-        for c in history:
-            one_hot_vector = [0] * VOCAB_SIZE
-            one_hot_vector[char2int[c]] = 1
-            inputs.extend(one_hot_vector)
-        input_layer = dy.inputVector(inputs)
-        hidden_layer = dy.tanh(W1 * input_layer + bias1)
-        probs = dy.softmax(W2 * hidden_layer + bias2)
-        probs = probs.npvalue()
+    out = []
+
+    while len(out) < max_length:
+        input_layer = dy.esum([W1[column] for column in history_columns(history)])
+        hidden_layer = dy.tanh(input_layer + bias1)
+        probs = np.exp(softmax.log_distribution(hidden_layer))
         next_symbol = np.random.choice(VOCAB_SIZE, p=probs/probs.sum())
         next_char = int2char[next_symbol]
+        if next_char == END_SYMBOL:
+            break
         out.append(next_char)
         history.append(next_char)
         history.pop(0)
-    return "".join(out[1:-1]) # strip the start/end symbols
+    return "".join(out)
 
 
-def multiple_train(trainer, sentences):
-    i = 1
-    aggr_loss = 0
-    aggr_symbols = 0
-    for sentence in sentences:
-        loss = do_one_sentence(sentence)
-        loss.backward()
-        loss_value = loss.value()
-        trainer.update()
-        aggr_loss += loss_value
-        aggr_symbols += len(sentence) + 1
-        if i % 1000 == 0:
-            print(i, aggr_loss/aggr_symbols, generate())
-            aggr_loss = 0
-            aggr_symbols = 0
-        i += 1
+# return the perplexity per char of the sentences (line numbers), computed in batches
+def perplexity(sentences):
+    loss = 0
+    symbols = 0
+    for start in range(0, len(sentences), BATCH_SIZE):
+        batch_loss, batch_symbols = do_one_batch([corpus[i] for i in sentences[start:start + BATCH_SIZE]])
+        loss += batch_loss.value()
+        symbols += batch_symbols
+    return math.exp(loss / symbols)
+
+
+def sample_hook(metrics):
+    return {"sample": generate()}
+
+
+def dev_hook(metrics):
+    return {"dev_ppl": perplexity(dev_sentences)}
+
+
+# train one batch, return its loss value and number of symbols
+def train_batch(trainer, batch):
+    loss, symbols = do_one_batch([corpus[i] for i in batch])
+    loss_value = loss.value()
+    loss.backward()
+    trainer.update()
+    return loss_value, symbols
+
+
+def multiple_train(trainer, sentences, reporter, epoch=0, first_batch=0):
+    # the order only depends on the epoch, so a resumed epoch can skip the batches already trained
+    sentences = list(sentences)
+    random.Random(epoch).shuffle(sentences)
+    batches = [sentences[start:start + BATCH_SIZE] for start in range(0, len(sentences), BATCH_SIZE)]
+    if WORKERS > 1:
+        # one step is a synchronized round of all workers
+        steps = parallel_rounds(pc, trainer, train_batch, batches, WORKERS, SYNC_EVERY, first_batch)
+    else:
+        steps = ((b + 1,) + train_batch(trainer, batches[b]) for b in range(first_batch, len(batches)))
+
+    done = first_batch
+    reporter.start(sum(len(batch) for batch in batches[:done]), epoch=epoch)
+    for b, loss_value, symbols in steps:
+        reporter.update(sum(len(batch) for batch in batches[done:b]), loss_value, symbols)
+        if b // CHECKPOINT_EVERY > done // CHECKPOINT_EVERY:
+            save_checkpoint(CHECKPOINT_FILE, pc, int2char, epoch, b)
+        done = b
+
+
+# export the parameters as int8 for the NumPy inference of quantized.py
+def export_quantized(filename):
+    arrays = softmax.arrays()
+    arrays["W1"] = params["W1"].as_array()
+    arrays["bias1"] = params["bias1"].as_array()
+    save_quantized(filename, "fixed-context", arrays, int2char, N=N)
+
+
+# continue from the last checkpoint if there is one (a finished training is just reloaded)
+first_epoch, first_batch = 0, 0
+if os.path.exists(CHECKPOINT_FILE):
+    checkpoint = load_checkpoint(CHECKPOINT_FILE)
+    restore_parameters(pc, checkpoint)
+    first_epoch, first_batch = checkpoint["epoch"], checkpoint["batch"]
+    print("resuming from", CHECKPOINT_FILE, "at epoch", first_epoch, "batch", first_batch)
 
+reporter = Reporter(REPORT_EVERY)
+reporter.add_hook(sample_hook, SAMPLE_EVERY)
+reporter.add_hook(dev_hook, DEV_EVERY)
 
 trainer = dy.SimpleSGDTrainer(pc)
-for _ in range(MAX_EPOCHS):
-    random.shuffle(sentences)
-    multiple_train(trainer, sentences)
+for epoch in range(first_epoch, MAX_EPOCHS):
+    multiple_train(trainer, sentences, reporter, epoch, first_batch if epoch == first_epoch else 0)
+    save_checkpoint(CHECKPOINT_FILE, pc, int2char, epoch + 1, 0)
+export_quantized(QUANTIZED_FILE)
@@ -1,69 +1,84 @@
 #!/usr/bin/env python3
 import dynet as dy
-import random
+import os
+import sys
+import math
 import numpy as np
 
+from checkpoint import save_checkpoint, load_checkpoint, restore_parameters, load_vocabulary
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vocabulary import Vocabulary, load_corpus, encode_lines
+
 START_SYMBOL = "<s>"
 END_SYMBOL = "</s>"
 
-data = open('input.txt', 'r').read() # should be simple plain text file
-characters = set(data)
-characters.add(START_SYMBOL)
-characters.add(END_SYMBOL)
-characters = list(characters)
-sentences = [x for x in data.splitlines() if x]
+CHECKPOINT_FILE = "fixedcontextnn_embeddings.npz"
+CHECKPOINT_EVERY = 1000 # batches
+
+# the non-empty lines of a simple plain text file, encoded once to a memory-mapped id array
+corpus = load_corpus('input.txt')
+# the vocabulary of a checkpoint has to be reused, otherwise the ids of the chars change
+characters = load_vocabulary(CHECKPOINT_FILE, set(corpus.vocabulary) | {START_SYMBOL, END_SYMBOL})
+vocabulary = Vocabulary(characters)
+corpus = corpus.remap(vocabulary)
 
-int2char = list(characters)
-char2int = {c:i for i, c in enumerate(characters)}
+int2char = vocabulary.symbols
+char2int = vocabulary.ids
 
 MAX_EPOCHS = 5
+BATCH_SIZE = 512 # number of n-grams per minibatch
 VOCAB_SIZE = len(characters)
-INPUT_DIM = VOCAB_SIZE
+INPUT_DIM = 32
 HIDDEN_DIM = 64
 
 N = 7
 
 pc = dy.ParameterCollection()
 params = {}
-#params["lookup"] = pc.add_lookup_parameters((VOCAB_SIZE, INPUT_DIM))
-params["W1"] = pc.add_parameters((HIDDEN_DIM, (N - 1) * VOCAB_SIZE))
+params["lookup"] = pc.add_lookup_parameters((VOCAB_SIZE, INPUT_DIM))
+params["W1"] = pc.add_parameters((HIDDEN_DIM, (N - 1) * INPUT_DIM))
 params["bias1"] = pc.add_parameters((HIDDEN_DIM,))
 params["W2"] = pc.add_parameters((VOCAB_SIZE, HIDDEN_DIM))
 params["bias2"] = pc.add_parameters((VOCAB_SIZE,))
 
 
-# return the N-grams for the given sentence (as pairs, divided in history and symbol to be predicted)
-def ngrams_from_sentence(sentence, N):
-    prefix = [START_SYMBOL] * (N - 1) # start out with N-1 start symbols
-    symbols = list(sentence) + [END_SYMBOL]
-    for last in symbols:
-        yield prefix, last
-        prefix.append(last)
-        prefix.pop(0)
+# return the N-grams of all sentences of a corpus as an integer matrix of histories (one row of N-1 char ids
+# per n-gram) and a vector of the chars to be predicted
+def ngram_windows(corpus, N):
+    # all sentences in one stream, each prefixed with N-1 start symbols and followed by the end symbol,
+    # so sentence i starts N * i + N - 1 positions later than in the corpus ids
+    shifts = N * np.arange(len(corpus)) + N - 1
+    stream = np.full(len(corpus.ids) + N * len(corpus), char2int[START_SYMBOL], dtype=np.int32)
+    stream[np.arange(len(corpus.ids)) + np.repeat(shifts, corpus.lengths())] = corpus.ids
+    stream[corpus.offsets[1:] + shifts] = char2int[END_SYMBOL]
 
+    # every window of N ids that ends with a real symbol is an n-gram; thanks to the padding
+    # its history never reaches into the previous sentence
+    windows = np.lib.stride_tricks.sliding_window_view(stream, N)
+    windows = windows[windows[:, -1] != char2int[START_SYMBOL]]
+    return np.ascontiguousarray(windows[:, :-1]), np.ascontiguousarray(windows[:, -1])
 
-# return compute loss of RNN for one sentence
-def do_one_sentence(sentence):
-    # setup the sentence
-    dy.renew_cg()
 
+# return the batched scores (before the softmax) for a matrix of histories
+def forward(histories):
+    lookup = params["lookup"]
     W1 = params["W1"]
     bias1 = params["bias1"]
     W2 = params["W2"]
     bias2 = params["bias2"]
-    loss = []
-    for history,next_char in ngrams_from_sentence(sentence, N):
-        inputs = []
-        for c in history:
-            one_hot_vector = [0] * VOCAB_SIZE
-            one_hot_vector[char2int[c]] = 1
-            inputs.extend(one_hot_vector)
-        input_layer = dy.inputVector(inputs)
-        hidden_layer = dy.tanh(W1 * input_layer + bias1)
-        probs = dy.softmax(W2 * hidden_layer + bias2)
-        loss.append( -dy.log(dy.pick(probs,char2int[next_char])) )
-    loss = dy.esum(loss)
-    return loss
+
+    # embed every history position of all n-grams at once and concatenate them
+    input_layer = dy.concatenate([dy.lookup_batch(lookup, histories[:, j].tolist()) for j in range(N - 1)])
+    hidden_layer = dy.tanh(W1 * input_layer + bias1)
+    return W2 * hidden_layer + bias2
+
+
+# return the summed loss of a minibatch of n-grams
+def do_one_batch(histories, next_chars):
+    dy.renew_cg()
+    loss = dy.pickneglogsoftmax_batch(forward(histories), next_chars.tolist())
+    return dy.sum_batches(loss)
 
 
 # generate from model:
@@ -71,50 +86,68 @@ def generate():
     # setup the sentence
     dy.renew_cg()
 
-    W1 = params["W1"]
-    bias1 = params["bias1"]
-    W2 = params["W2"]
-    bias2 = params["bias2"]
-    history = [START_SYMBOL] * (N-1)
+    history = [char2int[START_SYMBOL]] * (N-1)
     out=["<s>"]
 
     while out[-1] != END_SYMBOL:
-        inputs = []
-        for c in history:
-            one_hot_vector = [0] * VOCAB_SIZE
-            one_hot_vector[char2int[c]] = 1
-            inputs.extend(one_hot_vector)
-        input_layer = dy.inputVector(inputs)
-        hidden_layer = dy.tanh(W1 * input_layer + bias1)
-        probs = dy.softmax(W2 * hidden_layer + bias2)
+        probs = dy.softmax(forward(np.array([history])))
         probs = probs.npvalue()
         next_symbol = np.random.choice(VOCAB_SIZE, p=probs/probs.sum())
-        next_char = int2char[next_symbol]
-        out.append(next_char)
-        history.append(next_char)
+        out.append(int2char[next_symbol])
+        history.append(next_symbol)
         history.pop(0)
     return "".join(out[1:-1]) # strip the start/end symbols
 
 
-def multiple_train(trainer, sentences):
-    i = 1
+# return the cross entropy (in bits per symbol) of sentences, all n-grams are scored in minibatches
+def assess(sentences):
+    histories, next_chars = ngram_windows(encode_lines(sentences, vocabulary), N)
+    crossentropy = 0
+    for start in range(0, len(next_chars), BATCH_SIZE):
+        dy.renew_cg()
+        batch = slice(start, start + BATCH_SIZE)
+        loss = dy.pickneglogsoftmax_batch(forward(histories[batch]), next_chars[batch].tolist())
+        crossentropy += dy.sum_batches(loss).value() / math.log(2)
+    return crossentropy / len(next_chars), crossentropy, len(next_chars)
+
+
+def multiple_train(trainer, histories, next_chars, epoch=0, first_batch=0):
+    i = 0
     aggr_loss = 0
     aggr_symbols = 0
-    for sentence in sentences:
-        loss = do_one_sentence(sentence)
-        loss.backward()
+    # visit the n-grams of the whole corpus in random order, which only depends on the epoch
+    # (so a resumed epoch can skip the batches already trained)
+    order = np.random.RandomState(epoch).permutation(len(next_chars))
+    for b, start in enumerate(range(first_batch * BATCH_SIZE, len(order), BATCH_SIZE), first_batch):
+        batch = order[start:start + BATCH_SIZE]
+        loss = do_one_batch(histories[batch], next_chars[batch])
         loss_value = loss.value()
+        loss.backward()
         trainer.update()
         aggr_loss += loss_value
-        aggr_symbols += len(sentence) + 1
-        if i % 1000 == 0:
-            print(i, aggr_loss/aggr_symbols, generate())
+        aggr_symbols += len(batch)
+        # report about every 100000 n-grams
+        if (i + len(batch)) // 100000 > i // 100000:
+            print(i + len(batch), aggr_loss/aggr_symbols, generate(), "\n\t", assess(["His tender heir might bear his memory:"]))
             aggr_loss = 0
             aggr_symbols = 0
-        i += 1
+        i += len(batch)
+        if (b + 1) % CHECKPOINT_EVERY == 0:
+            save_checkpoint(CHECKPOINT_FILE, pc, int2char, epoch, b + 1)
+
+
+# extract the n-grams of the corpus once
+histories, next_chars = ngram_windows(corpus, N)
 
+# continue from the last checkpoint if there is one (a finished training is just reloaded)
+first_epoch, first_batch = 0, 0
+if os.path.exists(CHECKPOINT_FILE):
+    checkpoint = load_checkpoint(CHECKPOINT_FILE)
+    restore_parameters(pc, checkpoint)
+    first_epoch, first_batch = checkpoint["epoch"], checkpoint["batch"]
+    print("resuming from", CHECKPOINT_FILE, "at epoch", first_epoch, "batch", first_batch)
 
 trainer = dy.SimpleSGDTrainer(pc)
-for _ in range(MAX_EPOCHS):
-    random.shuffle(sentences)
-    multiple_train(trainer, sentences)
+for epoch in range(first_epoch, MAX_EPOCHS):
+    multiple_train(trainer, histories, next_chars, epoch, first_batch if epoch == first_epoch else 0)
+    save_checkpoint(CHECKPOINT_FILE, pc, int2char, epoch + 1, 0)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import multiprocessing
+import numpy as np
+
+from checkpoint import parameter_arrays, restore_parameters
+
+# state of a worker process, set once when the worker is forked
+worker = {}
+
+
+def init_worker(pc, trainer, train_batch):
+    worker["pc"] = pc
+    worker["trainer"] = trainer
+    worker["train_batch"] = train_batch
+
+
+# train the batches of one shard, starting from the given parameters;
+# return the new parameters, the summed loss and the number of symbols
+def train_shard(task):
+    arrays, shard = task
+    restore_parameters(worker["pc"], arrays)
+    aggr_loss = 0
+    aggr_symbols = 0
+    for batch in shard:
+        loss_value, symbols = worker["train_batch"](worker["trainer"], batch)
+        aggr_loss += loss_value
+        aggr_symbols += symbols
+    return parameter_arrays(worker["pc"]), aggr_loss, aggr_symbols
+
+
+# train the batches (from first_batch on) with several processes in synchronized rounds: in every round
+# each worker starts from the same parameters and trains sync_every batches of its own shard (batch b belongs
+# to worker b % workers), afterwards the parameters of all workers are averaged into pc.
+# train_batch(trainer, batch) has to train one batch and return its loss value and number of symbols.
+# Yields the number of batches done, the summed loss and the number of symbols after every round.
+def parallel_rounds(pc, trainer, train_batch, batches, workers, sync_every, first_batch=0):
+    # the workers are forked, so they share the model built by the script without pickling it
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, initializer=init_worker, initargs=(pc, trainer, train_batch)) as pool:
+        for start in range(first_batch, len(batches), workers * sync_every):
+            round_batches = batches[start:start + workers * sync_every]
+            shards = [round_batches[k::workers] for k in range(workers) if round_batches[k::workers]]
+
+            arrays = parameter_arrays(pc)
+            results = pool.map(train_shard, [(arrays, shard) for shard in shards])
+
+            # the merged model is the average of all workers
+            restore_parameters(pc, {name: np.mean([result[0][name] for result in results], axis=0)
+                                    for name in arrays})
+            yield start + len(round_batches), sum(result[1] for result in results), sum(result[2] for result in results)
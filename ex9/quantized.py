@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# int8 export and pure NumPy inference for the trained ex9 models, so serving needs no DyNet
+import math
+import os
+import numpy as np
+
+START_SYMBOL = "<s>"
+END_SYMBOL = "</s>"
+
+
+# quantize the rows of a matrix symmetrically to int8, returns the int8 matrix and the float32 scale of every row
+def quantize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scale = np.abs(matrix).max(axis=1) / 127
+    scale[scale == 0] = 1
+    return np.round(matrix / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+
+
+# save the arrays of a model as .npz: matrices as int8 with row scales, vectors (biases) as float32
+def save_quantized(filename, model, arrays, vocabulary, **info):
+    out = {"model": np.array(model), "vocabulary": np.array(vocabulary)}
+    for name, value in arrays.items():
+        value = np.asarray(value)
+        if value.ndim == 2 and value.dtype.kind == "f":
+            out[name], out[name + "_scale"] = quantize(value)
+        elif value.dtype.kind == "f":
+            out[name] = value.astype(np.float32)
+        else:
+            out[name] = value
+    out.update({name: np.array(value) for name, value in info.items()})
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, **out)
+    os.replace(filename + ".tmp", filename)
+
+
+# an int8 matrix with row scales, only single rows or matrix-vector products are dequantized
+class QuantizedMatrix:
+
+    def __init__(self, values, scale):
+        self.values = values
+        self.scale = scale
+
+    def __getitem__(self, row):
+        return self.values[row] * self.scale[row]
+
+    def __matmul__(self, vector):
+        return (self.values @ vector) * self.scale
+
+
+def log_softmax(scores):
+    scores = scores - scores.max()
+    return scores - math.log(np.exp(scores).sum())
+
+
+# base class of the models: subclasses define initial_state, next_state (after reading one id) and
+# hidden (the input of the softmax for a state)
+class QuantizedModel:
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.int2char = arrays["vocabulary"].tolist()
+        self.char2int = {c: i for i, c in enumerate(self.int2char)}
+        self.vocab_size = len(self.int2char)
+        if "softmax_W" in arrays:
+            self.W = self.matrix("softmax_W")
+            self.bias = arrays["softmax_bias"]
+        else:
+            # class-factored softmax, see softmax.ClassFactoredSoftmax
+            self.class_W = self.matrix("class_W")
+            self.class_bias = arrays["class_bias"]
+            self.class_sizes = arrays["class_sizes"]
+            self.W = self.matrix("word_W")
+            self.bias = arrays["word_bias"]
+            self.positions = arrays["positions"]
+            self.offsets = np.concatenate([[0], np.cumsum(self.class_sizes)])
+
+    def matrix(self, name):
+        return QuantizedMatrix(self.arrays[name], self.arrays[name + "_scale"])
+
+    # return the log probabilities of all ids after the state
+    def log_distribution(self, state):
+        h = self.hidden(state)
+        if not hasattr(self, "class_W"):
+            return log_softmax(self.W @ h + self.bias)
+
+        class_log_probs = log_softmax(self.class_W @ h + self.class_bias)
+        # the word matrices of all classes are stacked, so one product gives all scores
+        scores = self.W @ h + self.bias
+        word_log_probs = np.concatenate([log_softmax(scores[self.offsets[c]:self.offsets[c + 1]])
+                                         for c in range(len(self.class_sizes))])
+        return (word_log_probs + np.repeat(class_log_probs, self.class_sizes))[self.positions]
+
+    # generate a sentence continuing prefix (at most max_length chars)
+    def generate(self, prefix="", max_length=200):
+        state = self.initial_state()
+        for c in prefix:
+            state = self.next_state(state, self.char2int[c])
+        out = []
+        while len(out) < max_length:
+            # gumbel-max sampling on the log probabilities
+            log_probs = self.log_distribution(state)
+            next_char = int(np.argmax(log_probs - np.log(-np.log(np.random.random_sample(self.vocab_size)))))
+            if next_char == self.char2int[END_SYMBOL]:
+                break
+            out.append(self.int2char[next_char])
+            state = self.next_state(state, next_char)
+        return "".join(out)
+
+    # return the cross entropy per symbol, the cross entropy (in bits) and the number of symbols of a sentence
+    def assess(self, sentence):
+        state = self.initial_state()
+        crossentropy = 0
+        for c in list(sentence) + [END_SYMBOL]:
+            crossentropy -= float(self.log_distribution(state)[self.char2int[c]]) / math.log(2)
+            state = self.next_state(state, self.char2int[c])
+        return crossentropy / (len(sentence) + 1), crossentropy, len(sentence) + 1
+
+
+# the char RNN LM of charnnlm.py (SimpleRNNBuilder: h = tanh(x2h * x + h2h * h_prev + hb) for every layer)
+class QuantizedRNNLM(QuantizedModel):
+
+    def __init__(self, arrays):
+        super().__init__(arrays)
+        self.lookup = self.matrix("lookup")
+        self.layers = [(self.matrix("x2h_%d" % l), self.matrix("h2h_%d" % l), arrays["hb_%d" % l])
+                       for l in range(int(arrays["layers"]))]
+
+    def initial_state(self):
+        state = [np.zeros(len(hb), dtype=np.float32) for _, _, hb in self.layers]
+        return self.next_state(state, self.char2int[START_SYMBOL])
+
+    def next_state(self, state, id):
+        x = self.lookup[id]
+        new_state = []
+        for (x2h, h2h, hb), h in zip(self.layers, state):
+            x = np.tanh(x2h @ x + h2h @ h + hb)
+            new_state.append(x)
+        return new_state
+
+    def hidden(self, state):
+        return state[-1]
+
+
+# the fixed-context LM of fixedcontextnn.py, the state is the history (ids of the last N-1 chars)
+class QuantizedFixedContextLM(QuantizedModel):
+
+    def __init__(self, arrays):
+        super().__init__(arrays)
+        self.N = int(arrays["N"])
+        self.W1 = self.matrix("W1")
+        self.bias1 = arrays["bias1"]
+
+    def initial_state(self):
+        return (self.char2int[START_SYMBOL],) * (self.N - 1)
+
+    def next_state(self, state, id):
+        return state[1:] + (id,)
+
+    def hidden(self, state):
+        return np.tanh(sum(self.W1[j * self.vocab_size + c] for j, c in enumerate(state)) + self.bias1)
+
+
+MODELS = {"rnn": QuantizedRNNLM, "fixed-context": QuantizedFixedContextLM}
+
+
+# load a model saved by save_quantized
+def load_quantized(filename):
+    with np.load(filename) as f:
+        arrays = {name: f[name] for name in f.files}
+    return MODELS[str(arrays["model"])](arrays)
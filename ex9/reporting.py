@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import json
+import sys
+import time
+
+
+# collects the training metrics and calls hooks at fixed intervals (in trained sentences);
+# every report writes one JSON line with the metrics, the time spent in the hooks doesn't count
+# as training time, so symbols_per_sec is the real training throughput
+class Reporter:
+
+    def __init__(self, every=1000, output=sys.stdout):
+        self.every = every
+        self.output = output
+        self.hooks = [] # [hook, interval] pairs
+        self.start()
+
+    # add hook, a function getting the metrics dict and returning a dict of additional metrics;
+    # it is called every interval sentences (a multiple of every, default every report)
+    def add_hook(self, hook, interval=None):
+        self.hooks.append([hook, interval or self.every])
+
+    # start counting at sentences (e.g. when resuming an epoch)
+    def start(self, sentences=0, **info):
+        self.sentences = sentences
+        self.info = info
+        self.loss = 0
+        self.symbols = 0
+        self.train_time = 0
+        self.last_time = time.perf_counter()
+
+    # count a trained step and report if a multiple of every was reached
+    def update(self, sentences, loss, symbols):
+        now = time.perf_counter()
+        self.train_time += now - self.last_time
+        self.loss += loss
+        self.symbols += symbols
+        before, self.sentences = self.sentences, self.sentences + sentences
+        if self.sentences // self.every > before // self.every:
+            self.report(before)
+        self.last_time = time.perf_counter()
+
+    def report(self, before):
+        metrics = dict(self.info)
+        metrics.update(sentences=self.sentences,
+                       loss=self.loss / self.symbols if self.symbols else None,
+                       symbols_per_sec=self.symbols / self.train_time if self.train_time else None)
+        for hook, interval in self.hooks:
+            if self.sentences // interval > before // interval:
+                metrics.update(hook(metrics) or {})
+        print(json.dumps(metrics, ensure_ascii=False), file=self.output, flush=True)
+
+        self.loss = 0
+        self.symbols = 0
+        self.train_time = 0
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import dynet as dy
+import math
+import numpy as np
+
+
+# the usual softmax over the whole vocabulary: p(w | h) = softmax(W * h + bias)[w]
+class FullSoftmax:
+
+    def __init__(self, W, bias):
+        self.W = W
+        self.bias = bias
+
+    # return the summed negative log probabilities of ids for a batch of hidden states h
+    # (batch elements whose mask is 0 don't count)
+    def neg_log_softmax_batch(self, h, ids, mask=None):
+        loss = dy.pickneglogsoftmax_batch(self.W * h + self.bias, ids)
+        if mask is not None and 0 in mask:
+            loss = loss * dy.reshape(dy.inputVector(mask), (1,), len(mask))
+        return dy.sum_batches(loss)
+
+    # return the negative log probability of id for one hidden state h
+    def neg_log_softmax(self, h, id):
+        return dy.pickneglogsoftmax(self.W * h + self.bias, id)
+
+    # return the log probabilities of all ids as numpy array
+    def log_distribution(self, h):
+        return dy.log_softmax(self.W * h + self.bias).npvalue().reshape(-1)
+
+    # return the parameter values as dict of numpy arrays (for quantized.save_quantized)
+    def arrays(self):
+        return {"softmax_W": self.W.as_array(), "softmax_bias": self.bias.as_array()}
+
+
+# class-factored softmax: p(w | h) = p(class(w) | h) * p(w | class(w), h), with the symbols binned into
+# about sqrt(V) classes of equal frequency mass, so training costs O(sqrt(V)) per symbol instead of O(V).
+# The probabilities are still exactly normalized.
+class ClassFactoredSoftmax:
+
+    def __init__(self, pc, hidden_dim, counts, num_classes=None):
+        vocab_size = len(counts)
+        num_classes = num_classes or int(math.ceil(math.sqrt(vocab_size)))
+
+        # frequency binning: the most frequent symbols share the first classes (add one so unseen symbols get a class)
+        total = sum(counts) + vocab_size
+        classes = [[] for _ in range(num_classes)]
+        cumulative = 0
+        for i in sorted(range(vocab_size), key=lambda i: -counts[i]):
+            classes[min(int(cumulative * num_classes / total), num_classes - 1)].append(i)
+            cumulative += counts[i] + 1
+        self.classes = [c for c in classes if c]
+
+        self.word_class = [0] * vocab_size # class of every id
+        self.word_index = [0] * vocab_size # index of every id within its class
+        for c, members in enumerate(self.classes):
+            for j, i in enumerate(members):
+                self.word_class[i] = c
+                self.word_index[i] = j
+        # position of every id in the concatenation of all classes
+        self.positions = np.argsort(np.concatenate(self.classes))
+
+        self.class_W = pc.add_parameters((len(self.classes), hidden_dim))
+        self.class_bias = pc.add_parameters((len(self.classes),))
+        self.W = [pc.add_parameters((len(members), hidden_dim)) for members in self.classes]
+        self.bias = [pc.add_parameters((len(members),)) for members in self.classes]
+
+    def neg_log_softmax_batch(self, h, ids, mask=None):
+        # leave out the masked batch elements
+        keep = [j for j in range(len(ids)) if mask is None or mask[j]]
+        if not keep:
+            return dy.scalarInput(0)
+        if len(keep) < len(ids):
+            h = dy.pick_batch_elems(h, keep)
+        ids = [ids[j] for j in keep]
+
+        # loss of the classes of all batch elements
+        class_ids = [self.word_class[i] for i in ids]
+        loss = [dy.sum_batches(dy.pickneglogsoftmax_batch(self.class_W * h + self.class_bias, class_ids))]
+
+        # loss within the class, the batch elements of each class are computed together
+        groups = {}
+        for j, c in enumerate(class_ids):
+            groups.setdefault(c, []).append(j)
+        for c, elements in groups.items():
+            if len(self.classes[c]) == 1:
+                continue
+            hc = dy.pick_batch_elems(h, elements)
+            word_ids = [self.word_index[ids[j]] for j in elements]
+            loss.append(dy.sum_batches(dy.pickneglogsoftmax_batch(self.W[c] * hc + self.bias[c], word_ids)))
+        return dy.esum(loss)
+
+    def neg_log_softmax(self, h, id):
+        c = self.word_class[id]
+        loss = dy.pickneglogsoftmax(self.class_W * h + self.class_bias, c)
+        if len(self.classes[c]) > 1:
+            loss = loss + dy.pickneglogsoftmax(self.W[c] * h + self.bias[c], self.word_index[id])
+        return loss
+
+    def log_distribution(self, h):
+        # compute the class distribution and all distributions within the classes in one forward pass
+        parts = [dy.log_softmax(self.class_W * h + self.class_bias)]
+        parts += [dy.log_softmax(self.W[c] * h + self.bias[c]) for c in range(len(self.classes))]
+        values = dy.concatenate(parts).npvalue().reshape(-1)
+
+        class_log_probs = values[:len(self.classes)]
+        word_log_probs = values[len(self.classes):]
+        sizes = [len(members) for members in self.classes]
+        return (word_log_probs + np.repeat(class_log_probs, sizes))[self.positions]
+
+    # return the parameter values as dict of numpy arrays (for quantized.save_quantized),
+    # the matrices of all classes are stacked
+    def arrays(self):
+        return {"class_W": self.class_W.as_array(), "class_bias": self.class_bias.as_array(),
+                "word_W": np.concatenate([W.as_array() for W in self.W]),
+                "word_bias": np.concatenate([bias.as_array() for bias in self.bias]),
+                "class_sizes": np.array([len(members) for members in self.classes]),
+                "positions": self.positions}
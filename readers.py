@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Lazy line readers for corpora that don't fit into memory (shared by the exercises).
+
+All readers skip empty lines, strip the line ends and can be iterated several times (e.g. once per epoch)."""
+
+import os
+import random
+from array import array
+
+
+class LineReader:
+    """Streams the lines of one or more files, holding only the current line in memory"""
+
+    def __init__(self, filenames, encoding='utf-8'):
+        self.filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+        self.encoding = encoding
+
+    def __iter__(self):
+        for filename in self.filenames:
+            with open(filename, 'r', encoding=self.encoding) as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line:
+                        yield line
+
+    def symbols(self):
+        """Return the set of all characters of the lines"""
+
+        symbols = set()
+        for line in self:
+            symbols.update(line)
+
+        return symbols
+
+
+class ShuffledLineReader(LineReader):
+    """Streams the lines in approximately random order: every line read replaces a random line of a buffer
+    of buffer_size lines, which is returned instead (so memory is bounded by the buffer). The order only
+    depends on the seed, pass a different one per epoch."""
+
+    def __init__(self, filenames, buffer_size=10000, seed=0, encoding='utf-8'):
+        super().__init__(filenames, encoding)
+        self.buffer_size = buffer_size
+        self.seed = seed
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        buffer = []
+        for line in super().__iter__():
+            if len(buffer) < self.buffer_size:
+                buffer.append(line)
+                continue
+            i = rng.randrange(self.buffer_size)
+            yield buffer[i]
+            buffer[i] = line
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class IndexedLineReader(LineReader):
+    """Random access to the lines through an index of their byte offsets, built in one pass (28 bytes per
+    line: file index, start, end and length in characters). Lines are read with pread, so forked processes
+    can share a reader; every process opens the files on first access, close() closes the descriptors of
+    the current process (also when used as context manager)."""
+
+    def __init__(self, filenames, encoding='utf-8'):
+        super().__init__(filenames, encoding)
+        self.descriptors = {}  # file descriptors by process id
+        self.files = array('i')  # file index of every line
+        self.starts = array('q')  # byte offset of every line
+        self.ends = array('q')
+        self.lengths = array('q')  # length in characters
+        for f, filename in enumerate(self.filenames):
+            with open(filename, 'rb') as binary:
+                offset = 0
+                for line in binary:
+                    text = line.rstrip(b'\n')
+                    if text:
+                        self.files.append(f)
+                        self.starts.append(offset)
+                        self.ends.append(offset + len(text))
+                        self.lengths.append(len(text.decode(encoding)))
+                    offset += len(line)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        # every process opens the files itself
+        descriptors = self.descriptors.get(os.getpid())
+        if descriptors is None:
+            descriptors = self.descriptors[os.getpid()] = [os.open(filename, os.O_RDONLY) for filename in self.filenames]
+        data = os.pread(descriptors[self.files[i]], self.ends[i] - self.starts[i], self.starts[i])
+        return data.decode(self.encoding)
+
+    def length(self, i):
+        return self.lengths[i]
+
+    def close(self):
+        for descriptor in self.descriptors.pop(os.getpid(), ()):
+            os.close(descriptor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def shuffled(self, seed=0):
+        """Iterate over the lines in a random order that only depends on the seed"""
+
+        order = list(range(len(self)))
+        random.Random(seed).shuffle(order)
+        for i in order:
+            yield self[i]
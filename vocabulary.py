@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Vocabularies and integer-id corpora shared by the exercises (ex7, ex9, ex10).
+
+A corpus is encoded once into three files next to the text file: <text>.ids.npy (the ids of all lines
+one after another), <text>.offsets.npy (where every line starts, plus the total length) and
+<text>.vocab.json (the vocabulary and how the text was split). Loading memory-maps the arrays, so it
+takes constant time and forked processes share the pages."""
+
+import json
+import os
+from array import array
+
+import numpy as np
+
+from readers import LineReader
+
+
+class Vocabulary:
+    """Maps symbols to integer ids and back. Ids are assigned in order of addition, so they only
+    depend on the order of the symbols (use sorted() for sets) and are stable across runs."""
+
+    def __init__(self, symbols=()):
+        self.symbols = []  # id -> symbol
+        self.ids = {}  # symbol -> id
+        for symbol in symbols:
+            self.add(symbol)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self.ids
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def add(self, symbol):
+        """Add a symbol if it is not in the vocabulary yet and return its id"""
+
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+
+        return symbol_id
+
+    def encode(self, symbols, unknown=None):
+        """Convert symbols to ids; unknown symbols get the id unknown, or raise a KeyError if it is None"""
+
+        if unknown is None:
+            return [self.ids[symbol] for symbol in symbols]
+
+        return [self.ids.get(symbol, unknown) for symbol in symbols]
+
+    def decode(self, ids):
+        """Convert ids to symbols"""
+
+        return [self.symbols[i] for i in ids]
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.symbols, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            return cls(json.load(f))
+
+
+class Corpus:
+    """Lines of a text as ids: ids is one flat (memory-mapped) array, line i is ids[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, ids, offsets, vocabulary):
+        self.ids = ids
+        self.offsets = offsets
+        self.vocabulary = vocabulary
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def remap(self, vocabulary):
+        """Return the corpus with the ids of another vocabulary, which has to contain all symbols"""
+
+        mapping = np.array(vocabulary.encode(self.vocabulary.symbols), dtype=np.int32)
+        return Corpus(mapping[self.ids], self.offsets, vocabulary)
+
+
+def encode_lines(lines, vocabulary, split=list, add=False):
+    """Return an in-memory corpus of lines (split into symbols by split); unknown symbols are added to
+    the vocabulary if add is True and raise a KeyError otherwise"""
+
+    encode = vocabulary.add if add else vocabulary.ids.__getitem__
+    ids = array('i')
+    offsets = array('q', [0])
+    for line in lines:
+        ids.extend(encode(symbol) for symbol in split(line))
+        offsets.append(len(ids))
+
+    return Corpus(np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64), vocabulary)
+
+
+def corpus_files(filename):
+    return filename + '.ids.npy', filename + '.offsets.npy', filename + '.vocab.json'
+
+
+def split_name(split):
+    """Name of a split function as stored with the corpus (None for lambdas and local functions, which
+    can't be told apart by their name)"""
+
+    name = getattr(split, '__module__', None) or '', getattr(split, '__qualname__', repr(split))
+    name = '.'.join(part for part in name if part)
+    return None if '<' in name else name
+
+
+def encode_corpus(filename, split=list, vocabulary=None):
+    """Encode the non-empty lines of a text file (split into symbols by split) and save them next to it.
+    Without vocabulary the sorted symbols of the text are used, otherwise unknown symbols are added to it.
+    The text is streamed, only the ids are kept in memory."""
+
+    lines = LineReader(filename)
+    given_vocabulary = vocabulary is not None
+    if vocabulary is None:
+        vocabulary = Vocabulary(sorted({symbol for line in lines for symbol in split(line)}))
+    corpus = encode_lines(lines, vocabulary, split, add=True)
+
+    ids_file, offsets_file, vocabulary_file = corpus_files(filename)
+    np.save(ids_file, corpus.ids)
+    np.save(offsets_file, corpus.offsets)
+    with open(vocabulary_file, 'w') as f:
+        json.dump({'split': split_name(split), 'given_vocabulary': given_vocabulary,
+                   'symbols': vocabulary.symbols}, f, ensure_ascii=False)
+    return Corpus(np.load(ids_file, mmap_mode='r'), np.load(offsets_file, mmap_mode='r'), vocabulary)
+
+
+def load_corpus(filename, split=list, vocabulary=None):
+    """Load the encoded corpus of a text file. It is encoded (again) if there is none, the text is newer or
+    it was encoded differently: with another split, without the given vocabulary (the stored one has to
+    start with its symbols, the others are added to it) or with a vocabulary although none is given."""
+
+    files = corpus_files(filename)
+    if not all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(filename) for f in files):
+        return encode_corpus(filename, split, vocabulary)
+
+    ids_file, offsets_file, vocabulary_file = files
+    with open(vocabulary_file, 'r') as f:
+        info = json.load(f)
+    name = split_name(split)
+    if (not isinstance(info, dict) or name is None or info['split'] != name
+            or info['given_vocabulary'] != (vocabulary is not None)
+            or vocabulary is not None and info['symbols'][:len(vocabulary)] != vocabulary.symbols):
+        return encode_corpus(filename, split, vocabulary)
+
+    if vocabulary is None:
+        vocabulary = Vocabulary(info['symbols'])
+    else:
+        for symbol in info['symbols'][len(vocabulary):]:
+            vocabulary.add(symbol)
+    return Corpus(np.load(ids_file, mmap_mode='r'), np.load(offsets_file, mmap_mode='r'), vocabulary)